@@ -0,0 +1,278 @@
+"""A versioned JSON API for the Commentator app, served at '/api/v1' next to the HTML views. Clients
+log in once at '/api/v1/tokens' and send the token they get back in an 'Authorization: Bearer'
+header; every response is JSON, with no redirects or pages to scrape.
+
+The views run SQLAlchemy Core statements on the app's database session, so they share its pooled
+connections (and its routing of reads to replicas) with the HTML views, and each view commits
+once at the end of its changes.
+
+Input is checked with the forms in 'forms.py', so the API accepts exactly what the HTML forms do.
+
+Routes:
+POST /api/v1/users                      register a user
+POST /api/v1/tokens                     log in and get a token
+GET/DELETE /api/v1/users/<username>     a user's details, or delete the account
+GET/POST /api/v1/users/<username>/feedback    list (paged with '?after=' and '?limit=') or add feedback
+GET/PATCH/DELETE /api/v1/feedback/<id>  a piece of feedback, edit it, or delete it"""
+
+from datetime import datetime
+
+import sqlalchemy as sa
+from flask import Blueprint, current_app, request, jsonify, abort
+from itsdangerous import URLSafeTimedSerializer, BadSignature
+from werkzeug.datastructures import MultiDict
+from werkzeug.exceptions import HTTPException
+
+from models import db, User, Feedback
+from forms import RegisterForm, LoginForm, FeedbackForm
+from hashing import hasher, HashingBusy
+from cache import cache
+from throttle import login_throttle
+import search
+import feed
+import jobs
+
+bp = Blueprint("api", __name__, url_prefix="/api/v1")
+
+users = User.__table__
+feedback = Feedback.__table__
+
+def _serializer():
+    return URLSafeTimedSerializer(current_app.secret_key, salt="commentator-api-token")
+
+def issue_token(username):
+    """A function that returns a signed token that logs 'username' in to the API."""
+    return _serializer().dumps({"username": username})
+
+def token_username():
+    """A function that returns the username from the request's bearer token, or None if there is no
+    token or it is invalid or expired."""
+    scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        return None
+    try:
+        return _serializer().loads(token, max_age=current_app.config["API_TOKEN_MAX_AGE"])["username"]
+    except BadSignature:
+        return None
+
+def require_login():
+    """A function that returns the username of the logged-in client, or aborts with a 401."""
+    username = token_username()
+    if username is None:
+        abort(401, "A valid bearer token is required.")
+    return username
+
+def require_owner(username):
+    """A function that aborts with a 401 or 403 unless the client is logged in as 'username'."""
+    if require_login() != username:
+        abort(403, "You do not have permission to change this user's data.")
+
+def json_body():
+    """A function that returns the JSON object in the body of the request, or aborts with a 400."""
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        abort(400, "The request body must be a JSON object.")
+    return body
+
+def validate(form_class, data, fields):
+    """A function that checks the values of 'fields' in the dictionary 'data' against the rules of
+    'form_class' and returns the validated form, or aborts with a 422 listing each field's errors.
+    A field given as anything but a string (or null, which counts as missing) is an error too."""
+    values = {name: data.get(name) for name in fields}
+    wrong_types = {name: ["Must be a string."] for name, value in values.items()
+    if value is not None and not isinstance(value, str)}
+    form = form_class(formdata=MultiDict({name: value if isinstance(value, str) else ""
+    for name, value in values.items()}), meta={"csrf": False})
+    if not form.validate() or wrong_types:
+        response = jsonify(error="The request has invalid fields.", errors={**form.errors, **wrong_types})
+        response.status_code = 422
+        abort(response)
+    return form
+
+def user_json(row, full):
+    data = {"username": row.username, "first_name": row.first_name, "last_name": row.last_name,
+    "version": row.version}
+    if full:
+        data["email"] = row.email
+    return data
+
+def feedback_json(row):
+    return {"id": row.id, "title": row.title, "content": row.content, "username": row.username,
+    "version": row.version}
+
+CONFLICT = "The feedback has changed since it was read. Fetch it again and retry."
+
+def with_version(response, version):
+    """A function that sets the ETag of 'response' to 'version', for use in 'If-Match'."""
+    response.set_etag(str(version))
+    return response
+
+def conflict():
+    """A function that rolls back the changes of the request and aborts with a 409."""
+    db.session.rollback()
+    abort(409, CONFLICT)
+
+@bp.errorhandler(HTTPException)
+def http_error(error):
+    """An error handler that answers API errors with JSON instead of an HTML page."""
+    if error.response is not None:
+        return error.response
+    return jsonify(error=error.description), error.code
+
+@bp.errorhandler(HashingBusy)
+def hashing_busy(error):
+    return jsonify(error="The server is busy processing other logins. Please try again shortly."), 503, {
+    "Retry-After": "1"}
+
+@bp.route('/users', methods=["POST"])
+def register_user():
+    """A view function that registers a user from a JSON object with the fields of the registration
+    form. It returns the new user and a token for them with a 201, or a 409 if the username or email
+    is taken."""
+    form = validate(RegisterForm, json_body(),
+    ("username", "password", "email", "first_name", "last_name"))
+    pw_hash = hasher.generate_password_hash(form.password.data)
+    try:
+        db.session.execute(users.insert().values(username=form.username.data, password=pw_hash,
+        email=form.email.data, first_name=form.first_name.data, last_name=form.last_name.data,
+        version=1))
+        db.session.commit()
+    except sa.exc.IntegrityError:
+        db.session.rollback()
+        abort(409, "Username or email already taken.")
+    user = {"username": form.username.data, "first_name": form.first_name.data,
+    "last_name": form.last_name.data, "version": 1, "email": form.email.data}
+    return jsonify(user=user, token=issue_token(form.username.data)), 201, {
+    "Location": f"/api/v1/users/{form.username.data}"}
+
+@bp.route('/tokens', methods=["POST"])
+def create_token():
+    """A view function that logs a user in from a JSON object with 'username' and 'password' and
+    returns a token for them. Wrong credentials get a 401, and throttled logins a 429, as with
+    '/login'."""
+    form = validate(LoginForm, json_body(), ("username", "password"))
+    username, password = form.username.data, form.password.data
+    retry_after = login_throttle.retry_after(username, request.remote_addr)
+    if retry_after:
+        return jsonify(error="Too many failed login attempts. Please try again later."), 429, {
+        "Retry-After": str(int(retry_after) + 1)}
+
+    pw_hash = db.session.execute(sa.select(users.c.password)
+    .where(users.c.username == username, users.c.deleted_at.is_(None))).scalar()
+    if pw_hash is None:
+        valid = hasher.check_dummy(password)
+    else:
+        valid = hasher.check_password_hash(pw_hash, password)
+    if not valid:
+        login_throttle.failed(username, request.remote_addr)
+        abort(401, "Incorrect username/password combination.")
+
+    login_throttle.succeeded(username)
+    if hasher.needs_rehash(pw_hash):
+        db.session.execute(users.update().where(users.c.username == username)
+        .values(password=hasher.generate_password_hash(password)))
+        db.session.commit()
+    return jsonify(token=issue_token(username), expires_in=current_app.config["API_TOKEN_MAX_AGE"])
+
+@bp.route('/users/<username>', methods=["GET", "DELETE"])
+def user_details(username):
+    """A view function that returns a user's details (with their email only to the user themselves)
+    on a GET request, or deletes the account and all of its feedback on a DELETE request by its
+    owner, the same way the HTML route does."""
+    if request.method == "GET":
+        client = require_login()
+        row = db.session.execute(sa.select(users.c.username, users.c.email, users.c.first_name,
+        users.c.last_name, users.c.version).where(users.c.username == username,
+        users.c.deleted_at.is_(None))).first()
+        if row is None:
+            abort(404, "No such user.")
+        return jsonify(user=user_json(row, full=client == username))
+
+    require_owner(username)
+    if not jobs.remove_account(username):
+        abort(404, "No such user.")
+    return "", 204
+
+@bp.route('/users/<username>/feedback', methods=["GET", "POST"])
+def user_feedback(username):
+    """A view function that lists a user's feedback oldest first on a GET request, one page at a time
+    ('?after=<id>' continues after a piece of feedback, '?limit=' sets the page size up to
+    FEEDBACK_PAGE_SIZE_MAX), or adds a piece of feedback for its owner on a POST request."""
+    if request.method == "GET":
+        require_login()
+        after = request.args.get("after", type=int)
+        limit = request.args.get("limit", current_app.config['FEEDBACK_PAGE_SIZE'], type=int)
+        limit = max(1, min(limit, current_app.config['FEEDBACK_PAGE_SIZE_MAX']))
+        query = sa.select(feedback).where(feedback.c.username == username, feedback.c.deleted_at.is_(None))
+        if after is not None:
+            query = query.where(feedback.c.id > after)
+        if User.current_version(username) is None:
+            abort(404, "No such user.")
+        rows = db.session.execute(query.order_by(feedback.c.id).limit(limit + 1)).all()
+        next_after = rows[limit - 1].id if len(rows) > limit else None
+        return jsonify(feedback=[feedback_json(row) for row in rows[:limit]], next_after=next_after)
+
+    require_owner(username)
+    form = validate(FeedbackForm, json_body(), ("title", "content"))
+    result = db.session.execute(feedback.insert().values(title=form.title.data,
+    content=form.content.data, username=username, version=1))
+    feedback_id = result.inserted_primary_key[0]
+    search.index_rows([(feedback_id, form.title.data, form.content.data)])
+    User.bump_version(username, feedback_delta=1)
+    db.session.commit()
+    cache.invalidate_user(username)
+    feed.invalidate()
+    return jsonify(feedback={"id": feedback_id, "title": form.title.data, "content": form.content.data,
+    "username": username, "version": 1}), 201, {"Location": f"/api/v1/feedback/{feedback_id}"}
+
+@bp.route('/feedback/<int:feedback_id>', methods=["GET", "PATCH", "DELETE"])
+def feedback_details(feedback_id):
+    """A view function that returns a piece of feedback on a GET request, and lets its author edit
+    it on a PATCH request (with a JSON object of the feedback form's fields; missing fields keep
+    their values) or delete it on a DELETE request.
+
+    Responses carry the feedback's version as their ETag. A PATCH or DELETE with an 'If-Match' header
+    naming another version gets a 412, and a PATCH whose body has a 'version' other than the current
+    one gets a 409, so an edit is never made to feedback that changed after the client read it. The
+    change itself only applies to the version read here, so one made in the meantime is caught too."""
+    row = db.session.execute(sa.select(feedback)
+    .join(users, users.c.username == feedback.c.username).where(feedback.c.id == feedback_id,
+    feedback.c.deleted_at.is_(None), users.c.deleted_at.is_(None))).first()
+    if row is None:
+        abort(404, "No such feedback.")
+    if request.method == "GET":
+        return with_version(jsonify(feedback=feedback_json(row)), row.version)
+
+    require_owner(row.username)
+    if request.if_match and not request.if_match.contains(str(row.version)):
+        abort(412, "The feedback has changed since the version named in If-Match.")
+    current = (feedback.c.id == feedback_id) & (feedback.c.version == row.version)
+    if request.method == "DELETE":
+        if current_app.config['SOFT_DELETE']:
+            result = db.session.execute(feedback.update().where(current)
+            .values(deleted_at=datetime.utcnow(), version=feedback.c.version + 1))
+        else:
+            result = db.session.execute(feedback.delete().where(current))
+        if not result.rowcount:
+            conflict()
+        User.bump_version(row.username, feedback_delta=-1)
+        db.session.commit()
+        cache.invalidate_user(row.username)
+        feed.invalidate()
+        return "", 204
+
+    body = json_body()
+    if body.get("version", row.version) != row.version:
+        abort(409, CONFLICT)
+    form = validate(FeedbackForm, {"title": row.title, "content": row.content, **body}, ("title", "content"))
+    result = db.session.execute(feedback.update().where(current)
+    .values(title=form.title.data, content=form.content.data, version=feedback.c.version + 1))
+    if not result.rowcount:
+        conflict()
+    search.index_rows([(feedback_id, form.title.data, form.content.data)])
+    User.bump_version(row.username)
+    db.session.commit()
+    cache.invalidate_user(row.username)
+    feed.invalidate()
+    return with_version(jsonify(feedback={"id": feedback_id, "title": form.title.data,
+    "content": form.content.data, "username": row.username, "version": row.version + 1}), row.version + 1)
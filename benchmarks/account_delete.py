@@ -0,0 +1,88 @@
+"""A benchmark that compares deleting an account through the ORM cascade (loading every piece of
+feedback and deleting it row by row, as 'delete_user' used to) with 'User.delete_account' (bulk
+DELETE statements, optionally in batches).
+
+Run it from the project root against a scratch database, which it drops and recreates:
+    python -m benchmarks.account_delete --rows 10000 100000 --database-url sqlite:///bench.db"""
+
+import argparse
+import json
+import time
+import tracemalloc
+
+from flask import Flask
+
+from models import db, connect_db, User, Feedback
+
+#A bcrypt hash of 'benchmark-password', so seeding does not spend its time hashing.
+PASSWORD_HASH = "$2b$04$CZHt5VMRtDRKGC.UfDOWr.n11oWoMljBm7S0AzwVJbvrRd7p1geMO"
+
+def seed(rows):
+    """A function that recreates the schema and adds one user with 'rows' pieces of feedback."""
+    db.drop_all()
+    db.create_all()
+    db.session.add(User(username="benchuser", password=PASSWORD_HASH, email="bench@example.com",
+    first_name="Bench", last_name="User"))
+    db.session.commit()
+    for start in range(0, rows, 10000):
+        db.session.execute(Feedback.__table__.insert(), [{"title": f"Feedback {n}",
+        "content": "Some feedback content. " * 10, "username": "benchuser"}
+        for n in range(start, min(start + 10000, rows))])
+    db.session.commit()
+
+def delete_with_orm_cascade():
+    user = User.query.get("benchuser")
+    for feedback in user.feedback:
+        db.session.delete(feedback)
+    db.session.delete(user)
+    db.session.commit()
+
+def delete_in_bulk():
+    User.delete_account("benchuser")
+
+def delete_in_batches():
+    User.delete_account("benchuser", batch_size=10000)
+
+PATHS = {"orm_cascade": delete_with_orm_cascade, "bulk": delete_in_bulk, "batched": delete_in_batches}
+
+def measure(path, rows):
+    """A function that seeds 'rows' pieces of feedback, deletes the account with 'path', and returns
+    the time taken and the peak memory allocated while deleting."""
+    seed(rows)
+    db.session.remove()
+    tracemalloc.start()
+    start = time.perf_counter()
+    PATHS[path]()
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    assert Feedback.query.filter_by(username="benchuser").count() == 0
+    db.session.remove()
+    return {"path": path, "rows": rows, "seconds": round(elapsed, 3), "peak_mb": round(peak / 2**20, 1)}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--paths", nargs="+", choices=list(PATHS), default=list(PATHS))
+    parser.add_argument("--database-url", default="sqlite:///account_delete_bench.db")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON.")
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = args.database_url
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    connect_db(app)
+
+    with app.app_context():
+        results = [measure(path, rows) for rows in args.rows for path in args.paths]
+        db.drop_all()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"{'path':>12} {'rows':>8} {'seconds':>9} {'peak MB':>8}")
+        for result in results:
+            print(f"{result['path']:>12} {result['rows']:>8} {result['seconds']:>9} {result['peak_mb']:>8}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""A benchmark of how feedback content is stored and listed. For each content size it seeds one user
+with that much feedback, once stored as it is and once compressed (see 'CompressedText'), and reports
+the size of the database and how long listing the feedback takes when every column is loaded (as
+lists did before 'content' was deferred) and when the content is left out.
+
+Run it from the project root against a scratch database, which it drops and recreates:
+    python -m benchmarks.feedback_storage --rows 10000 --sizes 200 2000 10000 --database-url sqlite:///bench.db
+
+On SQLite the size is that of the whole database file after a VACUUM; on Postgres it is that of the
+feedback table including its TOAST table and indexes (Postgres compresses values over about 2kB
+itself, so compare against that before turning FEEDBACK_COMPRESS_THRESHOLD on)."""
+
+import argparse
+import json
+import random
+import statistics
+import time
+
+import sqlalchemy as sa
+from flask import Flask
+
+from models import db, connect_db, User, Feedback, CompressedText
+
+#A bcrypt hash of 'benchmark-password', so seeding does not spend its time hashing.
+PASSWORD_HASH = "$2b$04$CZHt5VMRtDRKGC.UfDOWr.n11oWoMljBm7S0AzwVJbvrRd7p1geMO"
+
+WORDS = ("the a and to of I you it was that this my for on is with but not so be have just like "
+"date dinner movie funny great terrible tips really never again maybe honestly restaurant talked "
+"hours laughed awkward coffee walk park weather friends family work weekend").split()
+
+def make_content(size, rng):
+    """A function that returns about 'size' characters of word salad, which compresses about as well
+    as real prose rather than as well as one repeated sentence."""
+    words = []
+    length = 0
+    while length < size:
+        words.append(rng.choice(WORDS))
+        length += len(words[-1]) + 1
+    return " ".join(words)[:size]
+
+def seed(rows, size):
+    """A function that recreates the schema and adds one user with 'rows' pieces of feedback of about
+    'size' characters each, compressed or not as CompressedText.threshold says."""
+    db.drop_all()
+    db.create_all()
+    db.session.add(User(username="benchuser", password=PASSWORD_HASH, email="bench@example.com",
+    first_name="Bench", last_name="User"))
+    db.session.commit()
+    rng = random.Random(size)
+    for start in range(0, rows, 1000):
+        db.session.execute(Feedback.__table__.insert(), [{"title": f"Feedback {n}",
+        "content": make_content(size, rng), "username": "benchuser"}
+        for n in range(start, min(start + 1000, rows))])
+    db.session.commit()
+
+def database_size():
+    """A function that returns the size in bytes of the stored feedback (see the module docstring)."""
+    if db.engine.dialect.name == "postgresql":
+        return db.session.execute(sa.text("SELECT pg_total_relation_size('feedback')")).scalar()
+    db.session.commit()
+    with db.engine.connect() as connection:
+        connection.execute(sa.text("VACUUM"))
+        return (connection.execute(sa.text("PRAGMA page_count")).scalar()
+        * connection.execute(sa.text("PRAGMA page_size")).scalar())
+
+def list_full_rows():
+    return Feedback.with_author(content=True).all()
+
+def list_without_content():
+    return Feedback.with_author().all()
+
+LISTINGS = {"full_rows": list_full_rows, "deferred": list_without_content}
+
+def time_listing(listing, repeat):
+    """A function that returns the median time in milliseconds of 'repeat' runs of 'listing', each
+    in a fresh session so nothing comes from the identity map."""
+    times = []
+    for _ in range(repeat):
+        db.session.remove()
+        start = time.perf_counter()
+        LISTINGS[listing]()
+        times.append(time.perf_counter() - start)
+    db.session.remove()
+    return round(statistics.median(times) * 1000, 1)
+
+def measure(rows, size, threshold, repeat):
+    """A function that seeds 'rows' pieces of feedback of 'size' characters, compressed above
+    'threshold' bytes (None for not at all), and returns the database size and listing times."""
+    CompressedText.threshold = threshold
+    try:
+        seed(rows, size)
+        result = {"rows": rows, "size": size, "storage": "plain" if threshold is None else "compressed",
+        "mb": round(database_size() / 2**20, 2)}
+        for listing in LISTINGS:
+            result[f"{listing}_ms"] = time_listing(listing, repeat)
+    finally:
+        CompressedText.threshold = None
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[200, 2000, 10000])
+    parser.add_argument("--threshold", type=int, default=512,
+    help="FEEDBACK_COMPRESS_THRESHOLD for the compressed runs.")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--database-url", default="sqlite:///feedback_storage_bench.db")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON.")
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = args.database_url
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    connect_db(app)
+
+    with app.app_context():
+        results = [measure(args.rows, size, threshold, args.repeat)
+        for size in args.sizes for threshold in (None, args.threshold)]
+        db.drop_all()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"{'size':>6} {'storage':>10} {'MB':>8} {'full rows ms':>13} {'deferred ms':>12}")
+        for result in results:
+            print(f"{result['size']:>6} {result['storage']:>10} {result['mb']:>8} "
+            f"{result['full_rows_ms']:>13} {result['deferred_ms']:>12}")
+
+if __name__ == "__main__":
+    main()
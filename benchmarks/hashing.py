@@ -0,0 +1,71 @@
+"""A benchmark that reports how many bcrypt hashes per second this host can compute at each work
+factor, to help choose a BCRYPT_LOG_ROUNDS setting that fits the login latency budget.
+
+Run it from the project root:
+    python -m benchmarks.hashing --rounds 8 10 12 13 --seconds 2 --workers 4"""
+
+import argparse
+import json
+import time
+
+from hashing import PasswordHasher
+
+def measure(hasher, seconds):
+    """A function that hashes a password with 'hasher' repeatedly for about 'seconds' seconds and
+    returns the number of hashes made and the time it took."""
+    count = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        hasher.generate_password_hash("benchmark-password")
+        count += 1
+    return count, time.perf_counter() - start
+
+def measure_parallel(hasher, seconds, workers):
+    """A function like 'measure' that keeps 'workers' hashes in flight at once."""
+    from concurrent.futures import ThreadPoolExecutor
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        def hash_until_deadline():
+            count = 0
+            while time.perf_counter() - start < seconds:
+                hasher.generate_password_hash("benchmark-password")
+                count += 1
+            return count
+        futures = [executor.submit(hash_until_deadline) for _ in range(workers)]
+        count = sum(future.result() for future in futures)
+    return count, time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rounds", type=int, nargs="+", default=[4, 8, 10, 12, 13, 14])
+    parser.add_argument("--seconds", type=float, default=2.0,
+    help="How long to hash for at each work factor.")
+    parser.add_argument("--workers", type=int, default=0,
+    help="Worker processes to hash in (0 hashes in this process only).")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON.")
+    args = parser.parse_args()
+
+    results = []
+    for rounds in args.rounds:
+        hasher = PasswordHasher(workers=args.workers, max_pending=max(args.workers, 1) * 2,
+        timeout=600, rounds=rounds)
+        if args.workers:
+            #Starts the pool before timing so process start-up is not counted.
+            hasher.generate_password_hash("warm-up")
+            count, elapsed = measure_parallel(hasher, args.seconds, args.workers)
+        else:
+            count, elapsed = measure(hasher, args.seconds)
+        hasher.shutdown()
+        results.append({"rounds": rounds, "hashes": count, "seconds": round(elapsed, 3),
+        "hashes_per_second": round(count / elapsed, 2),
+        "ms_per_hash": round(elapsed / count * 1000 * max(args.workers, 1), 2)})
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"{'rounds':>6} {'hashes/s':>10} {'ms/hash':>9}")
+        for result in results:
+            print(f"{result['rounds']:>6} {result['hashes_per_second']:>10} {result['ms_per_hash']:>9}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,252 @@
+"""A load test for the Commentator routes. It seeds a database with a configurable number of users
+and pieces of feedback, then drives '/register', '/login', '/users/<username>',
+'/feedback/<id>/update' (viewing and editing), '/feedback/<id>/delete', and '/users/<username>/delete'
+from several threads at once, and reports throughput and p50/p95/p99 latency for each route.
+
+By default the app runs in this process (through Flask's test client) on a scratch SQLite
+database. To test a real deployment, seed its database and point the benchmark at the server:
+    python -m benchmarks.routes --database-url postgresql://localhost/auth_practice_bench --seed-only
+    python -m benchmarks.routes --database-url postgresql://localhost/auth_practice_bench --no-seed \\
+        --url http://127.0.0.1:8000
+
+Results can be written as JSON (with the current commit) to track regressions over time:
+    python -m benchmarks.routes --users 50 --feedback 200 --requests 500 --concurrency 8 --json out.json"""
+
+import argparse
+import itertools
+import json
+import os
+import subprocess
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from app import create_app
+from models import db, User, Feedback
+from hashing import _generate_password_hash
+import migrations
+
+PASSWORD = "benchmark-password"
+
+class RemoteClient:
+    """Sends requests to a running server with the same get/post interface as Flask's test client
+    (not following redirects). It needs the 'requests' package, which the app itself does not."""
+
+    def __init__(self, base_url):
+        import requests
+        self.session = requests.Session()
+        self.base_url = base_url.rstrip("/")
+
+    def get(self, path):
+        return self.session.get(self.base_url + path, allow_redirects=False)
+
+    def post(self, path, data=None):
+        return self.session.post(self.base_url + path, data=data, allow_redirects=False)
+
+def percentile(sorted_values, fraction):
+    """A function that returns the value at 'fraction' (0 to 1) of a sorted list, by nearest rank."""
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, round(fraction * len(sorted_values) + 0.5) - 1))
+    return sorted_values[index]
+
+def seed(users, feedback, delete_users, rounds):
+    """A function that recreates the schema and adds 'users' users with 'feedback' pieces of feedback
+    each, plus 'delete_users' users for the account deletion benchmark. It returns the ids of each
+    user's feedback."""
+    db.drop_all()
+    migrations.schema_migrations.drop(db.engine, checkfirst=True)
+    migrations.upgrade(db.engine, log=lambda message: None)
+    pw_hash = _generate_password_hash(PASSWORD, rounds)
+    db.session.execute(User.__table__.insert(), [{"username": f"bench{n}", "password": pw_hash,
+    "email": f"bench{n}@example.com", "first_name": "Bench", "last_name": str(n)} for n in range(users)]
+    + [{"username": f"benchdel{n}", "password": pw_hash, "email": f"benchdel{n}@example.com",
+    "first_name": "Delete", "last_name": str(n)} for n in range(delete_users)])
+    for n in range(users):
+        db.session.execute(Feedback.__table__.insert(), [{"title": f"Feedback {i} by bench{n}",
+        "content": "Benchmark feedback content. " * 20, "username": f"bench{n}"} for i in range(feedback)])
+    db.session.commit()
+    ids = {}
+    for feedback_id, username in db.session.query(Feedback.id, Feedback.username).order_by(Feedback.id):
+        ids.setdefault(username, []).append(feedback_id)
+    db.session.remove()
+    return ids
+
+def run_scenario(name, make_client, worker, requests, concurrency):
+    """A function that runs 'worker(client, thread_number, request_number)' 'requests' times spread
+    over 'concurrency' threads (each with its own client) and returns its latency statistics. A
+    worker returns the response it timed, or None if it had nothing left to do."""
+    counter = itertools.count()
+    latencies, errors = [], 0
+    lock = threading.Lock()
+
+    def thread(thread_number):
+        nonlocal errors
+        client = make_client(thread_number)
+        while True:
+            request_number = next(counter)
+            if request_number >= requests:
+                return
+            start = time.perf_counter()
+            response = worker(client, thread_number, request_number)
+            elapsed = time.perf_counter() - start
+            if response is None:
+                return
+            with lock:
+                latencies.append(elapsed)
+                if response.status_code >= 400:
+                    errors += 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for future in [executor.submit(thread, n) for n in range(concurrency)]:
+            future.result()
+    wall = time.perf_counter() - start
+    latencies.sort()
+    return {"route": name, "requests": len(latencies), "errors": errors, "seconds": round(wall, 3),
+    "throughput_rps": round(len(latencies) / wall, 1) if wall else 0.0,
+    "p50_ms": round(percentile(latencies, 0.50) * 1000, 2),
+    "p95_ms": round(percentile(latencies, 0.95) * 1000, 2),
+    "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+    "max_ms": round(latencies[-1] * 1000, 2) if latencies else 0.0}
+
+def login(client, username):
+    client.post('/login', data={"username": username, "password": PASSWORD})
+    return client
+
+def benchmark(new_client, feedback_ids, args):
+    """A function that runs every route scenario and returns the list of their results."""
+    owner = lambda thread_number: f"bench{thread_number % args.users}"
+    logged_in = lambda thread_number: login(new_client(), owner(thread_number))
+    #Pieces of feedback each thread may delete, taken from the end of its user's list.
+    deletable = {username: ids[len(ids) // 2:] for username, ids in feedback_ids.items()}
+    deletable_lock = threading.Lock()
+
+    #Registered names include a per-run token so runs against an already seeded database never clash.
+    run = uuid.uuid4().hex[:6]
+
+    def register(client, thread_number, n):
+        return client.post('/register', data={"username": f"reg{run}-{n}", "password": PASSWORD,
+        "email": f"reg{run}-{n}@example.com", "first_name": "Reg", "last_name": str(n)})
+
+    def view_user(client, thread_number, n):
+        return client.get(f'/users/bench{n % args.users}')
+
+    def view_feedback(client, thread_number, n):
+        ids = feedback_ids[f"bench{n % args.users}"]
+        return client.get(f'/feedback/{ids[n % len(ids)]}/update')
+
+    def edit_feedback(client, thread_number, n):
+        ids = feedback_ids[owner(thread_number)]
+        return client.post(f'/feedback/{ids[n % (len(ids) // 2 or 1)]}/update',
+        data={"title": f"Edited {n}", "content": "Edited benchmark content."})
+
+    def delete_feedback(client, thread_number, n):
+        with deletable_lock:
+            ids = deletable[owner(thread_number)]
+            if not ids:
+                return None
+            feedback_id = ids.pop()
+        return client.post(f'/feedback/{feedback_id}/delete')
+
+    def delete_user(client, thread_number, n):
+        if n >= args.delete_users:
+            return None
+        #Logging in as the user to delete is part of setting up, so it is not timed separately.
+        client = login(new_client(), f"benchdel{n}")
+        return client.post(f'/users/benchdel{n}/delete')
+
+    scenarios = [
+        ("POST /register", lambda thread_number: new_client(), register),
+        ("POST /login", lambda thread_number: new_client(),
+        lambda client, thread_number, n: client.post('/login',
+        data={"username": f"bench{n % args.users}", "password": PASSWORD})),
+        ("GET /users/<username>", logged_in, view_user),
+        ("GET /feedback/<id>/update", logged_in, view_feedback),
+        ("POST /feedback/<id>/update", logged_in, edit_feedback),
+        ("POST /feedback/<id>/delete", logged_in, delete_feedback),
+        ("POST /users/<username>/delete", lambda thread_number: None, delete_user),
+    ]
+    results = []
+    for name, make_client, worker in scenarios:
+        if args.routes and not any(route in name for route in args.routes):
+            continue
+        results.append(run_scenario(name, make_client, worker, args.requests, args.concurrency))
+    return results
+
+def current_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+        check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--database-url", help="The database to seed (default: a scratch SQLite file).")
+    parser.add_argument("--url", help="Benchmark a running server at this URL instead of in-process.")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--feedback", type=int, default=50, help="Pieces of feedback per user.")
+    parser.add_argument("--requests", type=int, default=200, help="Requests per route.")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--delete-users", type=int, default=None,
+    help="Accounts to create for the account deletion benchmark (default: --requests).")
+    parser.add_argument("--bcrypt-rounds", type=int, default=4)
+    parser.add_argument("--routes", nargs="*", help="Only run routes whose name contains one of these.")
+    parser.add_argument("--seed-only", action="store_true", help="Seed the database and stop.")
+    parser.add_argument("--no-seed", action="store_true", help="Use an already seeded database.")
+    parser.add_argument("--json", metavar="FILE", help="Also write the results as JSON to FILE ('-' for stdout).")
+    args = parser.parse_args()
+    if args.delete_users is None:
+        args.delete_users = args.requests
+
+    scratch = None
+    if not args.database_url:
+        scratch = tempfile.NamedTemporaryFile(suffix=".db", delete=False)
+        args.database_url = f"sqlite:///{scratch.name}"
+    config = {"SQLALCHEMY_DATABASE_URI": args.database_url, "SQLALCHEMY_ECHO": False, "DEBUG": False,
+    "BCRYPT_LOG_ROUNDS": args.bcrypt_rounds, "QUERY_BUDGET": None,
+    "LOGIN_MAX_FAILURES_PER_IP": 10**9, "LOGIN_MAX_FAILURES_PER_USER": 10**9}
+    if args.database_url.startswith("sqlite"):
+        config["SQLALCHEMY_ENGINE_OPTIONS"] = {"connect_args": {"timeout": 30}}
+    app = create_app(config)
+
+    try:
+        with app.app_context():
+            if args.no_seed:
+                feedback_ids = {}
+                for feedback_id, username in db.session.query(Feedback.id, Feedback.username).order_by(
+                    Feedback.id):
+                    feedback_ids.setdefault(username, []).append(feedback_id)
+                db.session.remove()
+            else:
+                feedback_ids = seed(args.users, args.feedback, args.delete_users, args.bcrypt_rounds)
+        if args.seed_only:
+            return
+
+        new_client = (lambda: RemoteClient(args.url)) if args.url else app.test_client
+        results = benchmark(new_client, feedback_ids, args)
+    finally:
+        if scratch:
+            os.unlink(scratch.name)
+
+    print(f"{'route':<32} {'reqs':>6} {'errors':>6} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for result in results:
+        print(f"{result['route']:<32} {result['requests']:>6} {result['errors']:>6} "
+        f"{result['throughput_rps']:>8} {result['p50_ms']:>8} {result['p95_ms']:>8} {result['p99_ms']:>8}")
+
+    if args.json:
+        report = {"commit": current_commit(), "timestamp": datetime.utcnow().isoformat() + "Z",
+        "settings": {key: value for key, value in vars(args).items() if key != "json"},
+        "results": results}
+        if args.json == "-":
+            print(json.dumps(report, indent=2))
+        else:
+            with open(args.json, "w") as output:
+                json.dump(report, output, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+"""Bulk import and export of feedback for the Commentator app. Both work on streams one row at a
+time, so the amount of memory they use depends on the batch size rather than on how much feedback
+is being moved.
+
+Two formats are supported: 'ndjson' (one JSON object per line) and 'csv' (with a header row). Each
+row has a 'title' and a 'content'; exports also include the feedback's 'id'."""
+
+import csv
+import io
+import json
+
+import sqlalchemy as sa
+from werkzeug.datastructures import MultiDict
+
+from models import db, User, Feedback, ImportChunk
+from forms import FeedbackForm
+from cache import cache
+import search
+import feed
+
+FORMATS = ("ndjson", "csv")
+
+def text_lines(stream):
+    """A function that yields the lines of a binary (utf8) or text stream as strings."""
+    for line in stream:
+        yield line.decode("utf8") if isinstance(line, bytes) else line
+
+def stage_upload(job_id, lines, chunk_size=1024 * 1024):
+    """A function that stores an iterable of lines in the 'import_chunks' table for the import job
+    'job_id', as part of the current transaction. Lines are gathered into pieces of about
+    'chunk_size' characters, so only one piece is held in memory at a time."""
+    chunk = []
+    size = 0
+    seq = 0
+    for line in lines:
+        chunk.append(line)
+        size += len(line)
+        if size >= chunk_size:
+            db.session.execute(ImportChunk.__table__.insert().values(job_id=job_id, seq=seq,
+            data="".join(chunk)))
+            chunk, size, seq = [], 0, seq + 1
+    if chunk:
+        db.session.execute(ImportChunk.__table__.insert().values(job_id=job_id, seq=seq,
+        data="".join(chunk)))
+
+def staged_lines(job_id):
+    """A function that yields the lines stored by 'stage_upload' for the job 'job_id', reading one
+    piece at a time."""
+    table = ImportChunk.__table__
+    seq = 0
+    while True:
+        data = db.session.execute(sa.select(table.c.data).where(table.c.job_id == job_id,
+        table.c.seq == seq)).scalar()
+        if data is None:
+            return
+        yield from io.StringIO(data, newline="")
+        seq += 1
+
+def discard_upload(job_id):
+    """A function that deletes the lines stored for the job 'job_id', as part of the current
+    transaction."""
+    ImportChunk.query.filter_by(job_id=job_id).delete(synchronize_session=False)
+
+def read_rows(lines, fmt):
+    """A function that yields (line number, row) pairs from an iterable of 'ndjson' or 'csv' lines.
+    A row that cannot be parsed is yielded as None."""
+    if fmt == "csv":
+        reader = csv.DictReader(lines)
+        for row in reader:
+            yield reader.line_num, row
+    elif fmt == "ndjson":
+        for line_number, line in enumerate(lines, start=1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError:
+                row = None
+            yield line_number, row if isinstance(row, dict) else None
+    else:
+        raise ValueError(f"Unknown format {fmt!r}; expected one of {', '.join(FORMATS)}.")
+
+def validate_row(row):
+    """A function that checks a row against the same rules as 'FeedbackForm'. It returns a list of
+    error messages, which is empty if the row is valid. A title or content that is not text (such as
+    a number in NDJSON) is an error of its own and never reaches the form."""
+    if row is None:
+        return ["Row could not be parsed."]
+    wrong_types = [f"{name}: Must be text." for name in ("title", "content")
+    if row.get(name) is not None and not isinstance(row.get(name), str)]
+    if wrong_types:
+        return wrong_types
+    form = FeedbackForm(formdata=MultiDict({"title": row.get("title") or "",
+    "content": row.get("content") or ""}), meta={"csrf": False})
+    if form.validate():
+        return []
+    return [f"{name}: {message}" for name, messages in form.errors.items() for message in messages]
+
+def import_feedback(username, rows, batch_size=1000, max_errors=100, checkpoint=None, on_commit=None):
+    """A function that adds the valid rows from an iterable of (line number, row) pairs as feedback
+    written by 'username'. Rows are inserted and committed in batches of 'batch_size' with one
+    multi-row INSERT each. It returns a dictionary with the number of rows imported and the errors
+    for invalid rows (at most 'max_errors' of them, though every invalid row is skipped).
+
+    To resume an import that stopped partway, pass the last checkpoint it made: rows up to the line
+    it names are skipped, and its counts are carried on. 'on_commit' is called with a new checkpoint
+    (a dictionary of 'line', 'imported', and 'errors') just before each batch is committed, so it can
+    save the checkpoint in the same transaction as the rows."""
+    checkpoint = checkpoint or {"line": 0, "imported": 0, "errors": []}
+    imported = checkpoint["imported"]
+    errors = list(checkpoint["errors"])
+    batch = []
+    line_number = checkpoint["line"]
+
+    def insert(batch):
+        #Rows added from here on belong to this batch, which is how they are found to index them.
+        last_id = db.session.query(db.func.max(Feedback.id)).scalar() or 0
+        db.session.execute(Feedback.__table__.insert(), batch)
+        search.index_rows(db.session.query(Feedback.id, Feedback.title, Feedback.content)
+        .filter(Feedback.username == username, Feedback.id > last_id).all())
+        User.bump_version(username, feedback_delta=len(batch))
+        if on_commit is not None:
+            on_commit({"line": line_number, "imported": imported + len(batch), "errors": errors})
+        db.session.commit()
+
+    for line_number, row in rows:
+        if line_number <= checkpoint["line"]:
+            continue
+        messages = validate_row(row)
+        if messages:
+            if len(errors) < max_errors:
+                errors.append({"line": line_number, "errors": messages})
+            continue
+        batch.append({"title": row["title"], "content": row["content"], "username": username})
+        if len(batch) >= batch_size:
+            insert(batch)
+            imported += len(batch)
+            batch = []
+    if batch:
+        insert(batch)
+        imported += len(batch)
+
+    if imported:
+        cache.invalidate_user(username)
+        feed.invalidate()
+    return {"imported": imported, "errors": errors}
+
+def export_feedback(username, fmt, batch_size=1000):
+    """A function that yields a user's feedback, oldest first, as 'ndjson' or 'csv' text in chunks.
+    Rows are read through a server-side cursor 'batch_size' at a time, so the whole result is never
+    held in memory."""
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown format {fmt!r}; expected one of {', '.join(FORMATS)}.")
+    query = (db.session.query(Feedback.id, Feedback.title, Feedback.content)
+    .filter(Feedback.username == username, Feedback.deleted_at.is_(None)).order_by(Feedback.id)
+    .execution_options(stream_results=True).yield_per(batch_size))
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if fmt == "csv":
+        writer.writerow(["id", "title", "content"])
+    for count, row in enumerate(query, start=1):
+        if fmt == "csv":
+            writer.writerow([row.id, row.title, row.content])
+        else:
+            buffer.write(json.dumps({"id": row.id, "title": row.title, "content": row.content}) + "\n")
+        if count % batch_size == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
@@ -0,0 +1,181 @@
+"""Caching for the Commentator app. The cache sits in front of expensive pages (such as the user
+details page) and is invalidated by the routes that change the data on them.
+
+The backend is chosen with the CACHE_BACKEND setting:
+'lru': an in-process least-recently-used cache with a time to live. Each worker has its own.
+'redis': a cache shared by every worker, at CACHE_REDIS_URL. Needs the 'redis' package.
+'null': no caching at all.
+
+User details pages are cached under 'user_key' with the user's version in the key, so a change made
+by any process (which bumps the version) is never served from an old entry, and the routes that make
+changes also invalidate the user's entries to free them early. Pages showing flashed messages are
+neither served from nor stored in the cache, since those messages belong to one visitor. Pages carry
+an ETag made from the user's version, so a client that already has the current page gets a 304 after
+one small query. The feedback list is also cached on its own, so pages that cannot be cached whole
+(such as the first page after logging in, which shows a flashed message) do not render or query it
+again."""
+
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from metrics import metrics
+
+class LRUCache:
+    """An in-process cache holding at most 'max_entries' values. The least recently used value is
+    dropped when it is full, and values expire 'ttl' seconds after they are set."""
+
+    def __init__(self, max_entries=1024, ttl=60):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """A method that returns the value stored under 'key', or None if there is none or it expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires is not None and expires <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        """A method that stores 'value' under 'key' for 'ttl' seconds (or the default time to live).
+        A ttl of 0 stores the value until it is evicted."""
+        ttl = self.ttl if ttl is None else ttl
+        expires = time.monotonic() + ttl if ttl else None
+        with self._lock:
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        """A method that removes 'key' from the cache if it is there."""
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """A method that removes everything from the cache."""
+        with self._lock:
+            self._entries.clear()
+
+class RedisCache:
+    """A cache shared between processes, kept in Redis (or anything with the same get, set, delete,
+    and scan_iter methods, such as a local stand-in in tests). Values are stored as strings."""
+
+    def __init__(self, client, ttl=60, prefix="commentator:"):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    @classmethod
+    def from_url(cls, url, **kwargs):
+        """A class method that connects to the Redis server at 'url'."""
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("CACHE_BACKEND 'redis' needs the 'redis' package installed.")
+        return cls(redis.Redis.from_url(url), **kwargs)
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        if isinstance(value, bytes):
+            value = value.decode("utf8")
+        return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        self.client.set(self.prefix + key, value, ex=ttl or None)
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+    def clear(self):
+        for key in self.client.scan_iter(match=self.prefix + "*"):
+            self.client.delete(key)
+
+class NullCache:
+    """A cache that never stores anything."""
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value, ttl=None):
+        pass
+
+    def delete(self, key):
+        pass
+
+    def clear(self):
+        pass
+
+class Cache:
+    """The cache used by the app's routes, backed by whichever backend the app is configured with.
+    Entries that belong to a user are stored under a per-user generation token, so everything cached
+    for a user can be invalidated at once by replacing the token.
+
+    Settings read by 'init_app':
+    CACHE_BACKEND: 'lru', 'redis', or 'null'.
+    CACHE_DEFAULT_TTL: how many seconds an entry lives.
+    CACHE_MAX_ENTRIES: how many entries the 'lru' backend holds.
+    CACHE_REDIS_URL: the Redis server for the 'redis' backend."""
+
+    def __init__(self, backend=None):
+        self.backend = backend or NullCache()
+
+    def init_app(self, app):
+        """A method that sets up the backend named in the config of 'app'."""
+        name = app.config.get("CACHE_BACKEND", "lru")
+        ttl = app.config.get("CACHE_DEFAULT_TTL", 60)
+        if name == "lru":
+            self.backend = LRUCache(max_entries=app.config.get("CACHE_MAX_ENTRIES", 1024), ttl=ttl)
+        elif name == "redis":
+            self.backend = RedisCache.from_url(app.config["CACHE_REDIS_URL"], ttl=ttl)
+        elif name == "null":
+            self.backend = NullCache()
+        else:
+            raise ValueError(f"Unknown CACHE_BACKEND {name!r}.")
+
+    def get(self, key, name="default"):
+        """A method that returns the value cached under 'key' (or None), counting a hit or a miss
+        for the kind of entry 'name'."""
+        value = self.backend.get(key)
+        metrics.increment("cache_hits_total" if value is not None else "cache_misses_total", cache=name)
+        return value
+
+    def set(self, key, value, ttl=None):
+        """A method that caches 'value' under 'key'."""
+        self.backend.set(key, value, ttl)
+
+    def delete(self, key):
+        """A method that removes 'key' from the cache."""
+        self.backend.delete(key)
+
+    def clear(self):
+        """A method that removes everything from the cache."""
+        self.backend.clear()
+
+    def user_key(self, username, *parts):
+        """A method that returns the key for an entry belonging to the user 'username', made from the
+        user's current generation token and 'parts'."""
+        generation_key = f"user-generation:{username}"
+        generation = self.backend.get(generation_key)
+        if generation is None:
+            generation = uuid.uuid4().hex
+            self.backend.set(generation_key, generation, ttl=0)
+        return ":".join(["user", username, generation] + [str(part) for part in parts])
+
+    def invalidate_user(self, username):
+        """A method that makes every entry cached for the user 'username' unreachable. The entries
+        themselves are left to expire or be evicted."""
+        self.backend.delete(f"user-generation:{username}")
+        metrics.increment("cache_invalidations_total", cache="user")
+
+cache = Cache()
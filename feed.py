@@ -0,0 +1,34 @@
+"""The feed of everyone's recent feedback, shown at '/feedback'. Its first page is by far the most
+viewed, so it is kept in a small in-process cache for FEED_CACHE_TTL seconds and most views of it
+never reach the database. A change made in this process clears the cache at once; other processes
+show it within FEED_CACHE_TTL seconds."""
+
+from cache import Cache, LRUCache, NullCache
+from models import Feedback
+
+first_page = Cache(LRUCache(max_entries=1, ttl=5))
+
+def init_app(app):
+    """A function that sets how long the first page of the feed is cached from the config of 'app'
+    (0 or None turns the cache off)."""
+    ttl = app.config.get("FEED_CACHE_TTL", 5)
+    first_page.backend = LRUCache(max_entries=1, ttl=ttl) if ttl else NullCache()
+
+def recent_feedback(before=None, limit=20):
+    """A function that returns one page of the feed as a list of dictionaries (see
+    'Feedback.recent') plus the id to pass as 'before' for the next page. The first page comes from
+    the cache when it can."""
+    cacheable = before is None
+    if cacheable:
+        page = first_page.get(limit, "feed")
+        if page is not None:
+            return page
+    rows, next_before = Feedback.recent(before=before, limit=limit)
+    page = ([row._asdict() for row in rows], next_before)
+    if cacheable:
+        first_page.set(limit, page)
+    return page
+
+def invalidate():
+    """A function that drops the cached first page, after feedback is added, edited, or deleted."""
+    first_page.clear()
@@ -1,11 +1,12 @@
 """Forms for the Commentator app. There are forms for registering users, logging in users, editing users,
 adding feedback, and editing feedback."""
 
-from flask import Flask
+from flask import Flask, current_app
 from flask_sqlalchemy import SQLAlchemy
 from flask_wtf import FlaskForm
-from wtforms import StringField, PasswordField
-from wtforms.validators import InputRequired, Length, Email
+from wtforms import StringField, PasswordField, IntegerField
+from wtforms.validators import InputRequired, Length, Email, Optional, ValidationError
+from wtforms.widgets import HiddenInput
 
 class RegisterForm(FlaskForm):
     """A form used for registering a new user."""
@@ -27,7 +28,15 @@ class LoginForm(FlaskForm):
     password=PasswordField("Password", validators=[InputRequired()])
 
 class FeedbackForm(FlaskForm):
-    """A form used for editing or adding feedback."""
+    """A form used for editing or adding feedback. When editing, 'version' holds the version of the
+    feedback the form was filled in from, so an edit made to an older version can be refused. The
+    content may be at most FEEDBACK_MAX_LENGTH characters long, which each deployment sets."""
     title=StringField("Title (max 100 characters)", validators=[InputRequired("Title required"), 
     Length(max=30, message="Title must be 100 characters or less.")])
-    content=StringField("Content", validators=[InputRequired("Content required.")])
\ No newline at end of file
+    content=StringField("Content", validators=[InputRequired("Content required.")])
+    version=IntegerField(widget=HiddenInput(), validators=[Optional()])
+
+    def validate_content(self, field):
+        limit = current_app.config.get("FEEDBACK_MAX_LENGTH")
+        if limit is not None and len(field.data or "") > limit:
+            raise ValidationError(f"Content must be {limit} characters or less.")
\ No newline at end of file
@@ -0,0 +1,16 @@
+"""Gunicorn settings for the Commentator app. Run it with:
+    gunicorn -c gunicorn.conf.py "app:create_app('production')"
+
+The app is loaded once in the master process and workers are forked from it, which keeps start-up
+cheap. Creating the app does not connect to the database, and each worker disposes of the engine
+right after it is forked so it never shares a connection with another process."""
+
+import os
+
+bind = os.environ.get("BIND", "127.0.0.1:8000")
+workers = int(os.environ.get("WEB_CONCURRENCY", (os.cpu_count() or 1) * 2 + 1))
+preload_app = True
+
+def post_fork(server, worker):
+    from models import dispose_engine
+    dispose_engine(server.app.wsgi())
@@ -0,0 +1,142 @@
+"""Password hashing for the Commentator app. bcrypt is deliberately slow, so hashing is run in a
+pool of worker processes (outside of the GIL) with a cap on how many hashes can be waiting at once.
+When the cap is reached, new hashing requests are rejected right away instead of piling up behind
+the ones already running, which keeps cheap routes responsive during a burst of logins."""
+
+import os
+import secrets
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+
+import bcrypt
+
+from metrics import metrics
+import instrumentation
+
+class HashingBusy(Exception):
+    """Raised when the password hasher already has as many hashes pending as it is allowed."""
+
+DEFAULT_ROUNDS = 12
+
+def _generate_password_hash(password, rounds=DEFAULT_ROUNDS):
+    """A function that returns a bcrypt hash (as a utf8 string) of 'password' with a work factor of
+    'rounds'. It produces the same format as Flask-Bcrypt so existing hashes keep working."""
+    return bcrypt.hashpw(password.encode("utf8"), bcrypt.gensalt(rounds=rounds)).decode("utf8")
+
+def _check_password_hash(pw_hash, password):
+    """A function that returns True if 'password' matches the bcrypt hash 'pw_hash'."""
+    return bcrypt.checkpw(password.encode("utf8"), pw_hash.encode("utf8"))
+
+def hash_rounds(pw_hash):
+    """A function that returns the work factor stored in the bcrypt hash 'pw_hash' (the number
+    between the second and third '$', as in '$2b$12$...'), or None if it cannot be read."""
+    parts = pw_hash.split("$")
+    if len(parts) < 4 or not parts[2].isdigit():
+        return None
+    return int(parts[2])
+
+class PasswordHasher:
+    """Hashes and checks passwords in a pool of worker processes. The pool is created lazily (and
+    again after a fork) so importing the app does not start any processes.
+
+    Settings read by 'init_app':
+    BCRYPT_LOG_ROUNDS: the bcrypt work factor for new hashes (the same setting Flask-Bcrypt uses).
+    HASHING_WORKERS: the number of worker processes. 0 hashes in the calling thread instead.
+    HASHING_MAX_PENDING: how many hashes may be running or queued before new ones are rejected.
+    HASHING_TIMEOUT: how many seconds a caller waits for a hash before giving up."""
+
+    def __init__(self, workers=0, max_pending=32, timeout=10, rounds=DEFAULT_ROUNDS):
+        self.rounds = rounds
+        self._dummy_hash = None
+        self.configure(workers, max_pending, timeout)
+        self._pool = None
+        self._pool_pid = None
+        self._pool_lock = threading.Lock()
+
+    def init_app(self, app):
+        """A method that configures the hasher from the config of 'app'."""
+        self.rounds = app.config.get("BCRYPT_LOG_ROUNDS", DEFAULT_ROUNDS)
+        workers = app.config.get("HASHING_WORKERS", os.cpu_count() or 1)
+        self.configure(workers=workers,
+        max_pending=app.config.get("HASHING_MAX_PENDING", max(workers, 1) * 4),
+        timeout=app.config.get("HASHING_TIMEOUT", 10))
+
+    def configure(self, workers, max_pending, timeout):
+        """A method that sets the size of the pool, the cap on pending hashes, and the timeout."""
+        self.workers = workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self.shutdown()
+
+    def shutdown(self):
+        """A method that stops the worker processes, if any are running."""
+        pool = getattr(self, "_pool", None)
+        if pool is not None and self._pool_pid == os.getpid():
+            pool.shutdown(wait=False)
+        self._pool = None
+        self._pool_pid = None
+
+    def _get_pool(self):
+        with self._pool_lock:
+            #A pool inherited through a fork belongs to the parent process, so start a new one.
+            if self._pool is None or self._pool_pid != os.getpid():
+                self._pool = ProcessPoolExecutor(max_workers=self.workers)
+                self._pool_pid = os.getpid()
+            return self._pool
+
+    def _run(self, operation, func, *args):
+        if not self._slots.acquire(blocking=False):
+            metrics.increment("password_hash_rejected_total", operation=operation)
+            raise HashingBusy(f"Too many password hashes pending (limit {self.max_pending}).")
+
+        start = time.perf_counter()
+        try:
+            if not self.workers:
+                try:
+                    return func(*args)
+                finally:
+                    self._slots.release()
+            try:
+                future = self._get_pool().submit(func, *args)
+            except Exception:
+                self._slots.release()
+                raise
+            #The slot is freed when the worker finishes, even if this caller times out first.
+            future.add_done_callback(lambda _: self._slots.release())
+            try:
+                return future.result(timeout=self.timeout)
+            except FutureTimeoutError:
+                metrics.increment("password_hash_timeouts_total", operation=operation)
+                raise HashingBusy(f"Password hash did not finish within {self.timeout} seconds.")
+        finally:
+            elapsed = time.perf_counter() - start
+            metrics.observe("password_hash_seconds", elapsed, operation=operation)
+            instrumentation.record("bcrypt", elapsed)
+
+    def generate_password_hash(self, password):
+        """A method that returns a bcrypt hash of 'password' as a utf8 string, using the configured
+        work factor."""
+        return self._run("generate", _generate_password_hash, password, self.rounds)
+
+    def check_password_hash(self, pw_hash, password):
+        """A method that returns True if 'password' matches the stored hash 'pw_hash'."""
+        return self._run("check", _check_password_hash, pw_hash, password)
+
+    def check_dummy(self, password):
+        """A method that checks 'password' against the hash of a random password at the configured
+        work factor and returns False. Calling it when there is no stored hash to check (such as for
+        a username that does not exist) takes as long as a real check, so response times do not
+        reveal which usernames exist."""
+        if self._dummy_hash is None or hash_rounds(self._dummy_hash) != self.rounds:
+            self._dummy_hash = _generate_password_hash(secrets.token_hex(16), self.rounds)
+        self.check_password_hash(self._dummy_hash, password)
+        return False
+
+    def needs_rehash(self, pw_hash):
+        """A method that returns True if 'pw_hash' was made with a different work factor than the
+        one currently configured, meaning it should be replaced the next time the password is known."""
+        return hash_rounds(pw_hash) != self.rounds
+
+hasher = PasswordHasher()
@@ -0,0 +1,96 @@
+"""Request instrumentation for the Commentator app. Each request's time is split into time spent
+on database queries, bcrypt hashing, and template rendering, and the number of queries is counted.
+The results are recorded in the metrics registry (served at '/metrics' in the Prometheus text
+format) and, if SERVER_TIMING is on, sent to the browser in a 'Server-Timing' header.
+
+Settings read by 'init_app':
+METRICS_ENDPOINT: serve '/metrics' (default True, but False in the production configuration,
+since the metrics name every route and show how busy the app is).
+METRICS_ALLOWED_ADDRESSES: the client addresses '/metrics' answers; others get a 404. Empty lets
+anyone read it.
+SERVER_TIMING: add a 'Server-Timing' header to every response (default False).
+QUERY_BUDGET: log a warning when a request runs more queries than this, which usually means a
+query is being run once per row (an N+1 query). None turns the warning off."""
+
+import time
+
+import sqlalchemy as sa
+from flask import (g, request, current_app, has_app_context, before_render_template, template_rendered,
+    Response, abort)
+
+from metrics import metrics
+
+KINDS = ("db", "bcrypt", "render")
+
+def record(kind, seconds):
+    """A function that adds 'seconds' to the time the current request has spent on 'kind' (one of
+    'db', 'bcrypt', or 'render'). Outside of an instrumented request it does nothing."""
+    if has_app_context():
+        timings = g.get("request_timings")
+        if timings is not None:
+            timings[kind] += seconds
+
+@sa.event.listens_for(sa.engine.Engine, "before_cursor_execute")
+def _before_query(connection, cursor, statement, parameters, context, executemany):
+    connection.info.setdefault("query_start", []).append(time.perf_counter())
+
+@sa.event.listens_for(sa.engine.Engine, "after_cursor_execute")
+def _after_query(connection, cursor, statement, parameters, context, executemany):
+    start = connection.info["query_start"].pop()
+    record("db", time.perf_counter() - start)
+    if has_app_context() and g.get("request_timings") is not None:
+        g.query_count += 1
+
+def _before_render(sender, template, context, **extra):
+    if has_app_context():
+        g.setdefault("render_starts", []).append(time.perf_counter())
+
+def _after_render(sender, template, context, **extra):
+    if has_app_context() and g.get("render_starts"):
+        record("render", time.perf_counter() - g.render_starts.pop())
+
+def _start_request():
+    g.request_start = time.perf_counter()
+    g.request_timings = dict.fromkeys(KINDS, 0.0)
+    g.query_count = 0
+
+def _finish_request(response):
+    timings = g.get("request_timings")
+    if timings is None:
+        return response
+    total = time.perf_counter() - g.request_start
+    route = request.endpoint or "unmatched"
+    labels = {"route": route, "method": request.method}
+    metrics.observe("http_request_seconds", total, status=str(response.status_code), **labels)
+    for kind in KINDS:
+        metrics.observe(f"http_request_{kind}_seconds", timings[kind], **labels)
+    metrics.observe("http_request_queries", g.query_count, **labels)
+
+    budget = current_app.config.get("QUERY_BUDGET")
+    if budget is not None and g.query_count > budget:
+        metrics.increment("query_budget_exceeded_total", route=route)
+        current_app.logger.warning("%s %s ran %d queries (budget %d); look for a query run once per row.",
+        request.method, request.path, g.query_count, budget)
+
+    if current_app.config.get("SERVER_TIMING"):
+        response.headers["Server-Timing"] = ", ".join(
+        [f"{kind};dur={timings[kind] * 1000:.1f}" for kind in KINDS]
+        + [f'queries;desc="{g.query_count} queries"', f"total;dur={total * 1000:.1f}"])
+    return response
+
+def metrics_view():
+    """A view function that returns every metric in the Prometheus text format to the clients in
+    METRICS_ALLOWED_ADDRESSES."""
+    allowed = current_app.config.get("METRICS_ALLOWED_ADDRESSES")
+    if allowed and request.remote_addr not in allowed:
+        abort(404)
+    return Response(metrics.render_prometheus(), mimetype="text/plain; version=0.0.4")
+
+def init_app(app):
+    """A function that instruments every request to 'app' and serves '/metrics'."""
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+    before_render_template.connect(_before_render, app)
+    template_rendered.connect(_after_render, app)
+    if app.config.get("METRICS_ENDPOINT", True):
+        app.add_url_rule("/metrics", "metrics", metrics_view)
@@ -0,0 +1,277 @@
+"""A queue of background jobs for the Commentator app, for slow work such as deleting a huge account
+or importing a large file. The queue is the 'jobs' table of the app's database, so it needs nothing
+else to run. A request enqueues a job in its own transaction, so the job exists exactly when the
+request's changes are committed, and returns at once; 'flask run-worker' runs the jobs in another
+process.
+
+Any number of workers can share the queue. On Postgres each claims its next job with SELECT ... FOR
+UPDATE SKIP LOCKED, so workers never wait on each other; the claim itself is an UPDATE that only
+succeeds while the job is still queued, so a job is never run twice at once on any database.
+
+A job that raises is tried again after JOB_RETRY_DELAY seconds, then twice that, and so on, until
+it has been tried JOB_MAX_ATTEMPTS times; it is then left 'failed' with its last error. A job still
+'running' after JOB_TIMEOUT seconds lost its worker and is queued again, unless it has used up its
+attempts (it may be what stopped the worker), in which case it is left 'failed'. Finished jobs are
+removed after JOB_KEEP_FINISHED seconds. A job that commits its work in steps can save a checkpoint
+with each one ('save_checkpoint') so that a retry carries on from there instead of starting over.
+
+Metrics: the worker records 'job_seconds' (by job and outcome) and 'job_wait_seconds' (how long each
+job waited past its due time) and logs both for every job, and '/metrics' reports
+'job_queue_depth' (by job and status) and 'job_queue_oldest_seconds' read from the table."""
+
+import json
+import signal
+import time
+import traceback
+from datetime import datetime, timedelta
+
+import click
+import sqlalchemy as sa
+from flask import current_app, has_app_context, g
+from flask.cli import with_appcontext
+
+from models import db, User, Feedback, Job, ImportChunk
+from metrics import metrics
+from cache import cache
+import bulk
+import feed
+import sessions
+
+HANDLERS = {}
+
+def handler(name):
+    """A decorator that registers a function as the handler of the jobs called 'name'. It is called
+    inside an app context with the job's payload as keyword arguments, and what it returns (which
+    must be JSON serializable) is kept as the job's result."""
+    def register(func):
+        HANDLERS[name] = func
+        return func
+    return register
+
+def enqueue(name, delay=0, **payload):
+    """A function that queues the job 'name' to run with 'payload' after 'delay' seconds and returns
+    it. The job is added to the current database session and is committed along with it."""
+    if name not in HANDLERS:
+        raise ValueError(f"There is no handler for jobs called {name!r}.")
+    now = datetime.utcnow()
+    job = Job(name=name, payload=json.dumps(payload), status="queued", attempts=0, enqueued_at=now,
+    run_at=now + timedelta(seconds=delay))
+    db.session.add(job)
+    db.session.flush()
+    metrics.increment("jobs_enqueued_total", job=name)
+    return job
+
+def load_checkpoint():
+    """A function that returns the checkpoint the running job saved on an earlier attempt, or None."""
+    checkpoint = db.session.execute(sa.select(Job.checkpoint).where(Job.id == g.job_id)).scalar()
+    return json.loads(checkpoint) if checkpoint else None
+
+def save_checkpoint(checkpoint):
+    """A function that saves 'checkpoint' (which must be JSON serializable) for the running job as
+    part of the current transaction, so it is committed along with the work it describes."""
+    db.session.execute(sa.update(Job).where(Job.id == g.job_id).values(checkpoint=json.dumps(checkpoint))
+    .execution_options(synchronize_session=False))
+
+def claim(now=None):
+    """A function that marks the oldest due job as running and returns it, or returns None if no job
+    is due. The claim is committed at once so other workers pass over the job."""
+    now = now or datetime.utcnow()
+    while True:
+        job_id = db.session.execute(sa.select(Job.id).where(Job.status == "queued", Job.run_at <= now)
+        .order_by(Job.run_at, Job.id).limit(1).with_for_update(skip_locked=True)).scalar()
+        if job_id is None:
+            db.session.commit()
+            return None
+        claimed = db.session.execute(sa.update(Job).where(Job.id == job_id, Job.status == "queued")
+        .values(status="running", started_at=now, attempts=Job.attempts + 1)
+        .execution_options(synchronize_session=False)).rowcount
+        db.session.commit()
+        #Another worker may have claimed the job first where SKIP LOCKED is not supported.
+        if claimed:
+            return Job.query.get(job_id)
+
+def run(job):
+    """A function that runs a claimed job and records how it went: 'done' with its result, queued
+    again for later if it raised and has attempts left, or otherwise 'failed'. It returns 'done',
+    'retried', or 'failed'."""
+    config = current_app.config
+    job_id, name, wait = job.id, job.name, max((job.started_at - job.run_at).total_seconds(), 0.0)
+    start = time.perf_counter()
+    g.job_id = job_id
+    try:
+        result = HANDLERS[name](**json.loads(job.payload))
+    except Exception:
+        error = traceback.format_exc()
+        db.session.rollback()
+        job = Job.query.get(job_id)
+        if job.attempts < config['JOB_MAX_ATTEMPTS']:
+            job.status = "queued"
+            job.run_at = datetime.utcnow() + timedelta(
+            seconds=config['JOB_RETRY_DELAY'] * 2 ** (job.attempts - 1))
+            outcome = "retried"
+        else:
+            job.status = "failed"
+            job.finished_at = datetime.utcnow()
+            outcome = "failed"
+        job.last_error = error
+        current_app.logger.warning("Job %d (%s) failed on attempt %d:\n%s", job_id, name, job.attempts,
+        error)
+    else:
+        job = Job.query.get(job_id)
+        job.status = "done"
+        job.finished_at = datetime.utcnow()
+        job.result = json.dumps(result)
+        outcome = "done"
+    finally:
+        g.pop("job_id", None)
+    db.session.commit()
+    seconds = time.perf_counter() - start
+    metrics.observe("job_seconds", seconds, job=name, outcome=outcome)
+    metrics.observe("job_wait_seconds", wait, job=name)
+    current_app.logger.info("Job %d (%s) %s in %.3fs after waiting %.3fs.", job_id, name, outcome,
+    seconds, wait)
+    return outcome
+
+def requeue_stale(timeout, max_attempts=None, now=None):
+    """A function that queues again every job that has been running for more than 'timeout' seconds,
+    whose worker must have stopped, and returns how many there were. Jobs that have already been
+    tried 'max_attempts' times are left 'failed' instead, since they may be what stops workers."""
+    now = now or datetime.utcnow()
+    stale = (Job.status == "running") & (Job.started_at < now - timedelta(seconds=timeout))
+    if max_attempts is not None:
+        db.session.execute(sa.update(Job).where(stale, Job.attempts >= max_attempts)
+        .values(status="failed", finished_at=now,
+        last_error=f"The job was still running after {timeout} seconds, so its worker had stopped.")
+        .execution_options(synchronize_session=False))
+    count = db.session.execute(sa.update(Job).where(stale).values(status="queued", run_at=now)
+    .execution_options(synchronize_session=False)).rowcount
+    db.session.commit()
+    return count
+
+def prune(keep, now=None):
+    """A function that deletes the jobs that finished successfully more than 'keep' seconds ago and
+    returns how many there were. Failed jobs are kept so their errors can be looked into, along with
+    any upload they were importing."""
+    now = now or datetime.utcnow()
+    finished = sa.select(Job.id).where(Job.status == "done", Job.finished_at < now - timedelta(seconds=keep))
+    ImportChunk.query.filter(ImportChunk.job_id.in_(finished)).delete(synchronize_session=False)
+    count = Job.query.filter(Job.id.in_(finished)).delete(synchronize_session=False)
+    db.session.commit()
+    return count
+
+def work(once=False, poll_interval=1.0, stop=lambda: False):
+    """A function that claims and runs due jobs one at a time until 'stop()' returns True, waiting
+    'poll_interval' seconds whenever none are due. With 'once', it returns as soon as none are due
+    instead. It returns the number of jobs it ran."""
+    config = current_app.config
+    ran = 0
+    next_cleanup = 0.0
+    while not stop():
+        if time.monotonic() >= next_cleanup:
+            requeue_stale(config['JOB_TIMEOUT'], config['JOB_MAX_ATTEMPTS'])
+            prune(config['JOB_KEEP_FINISHED'])
+            next_cleanup = time.monotonic() + min(config['JOB_TIMEOUT'], 300)
+        job = claim()
+        if job is None:
+            if once:
+                break
+            time.sleep(poll_interval)
+            continue
+        run(job)
+        ran += 1
+    return ran
+
+def queue_gauges():
+    """A metrics collector that reports how many jobs of each kind are queued, running, and failed,
+    and how long the oldest due job of each kind has been waiting."""
+    if not has_app_context():
+        return []
+    now = datetime.utcnow()
+    rows = db.session.execute(sa.select(Job.name, Job.status, sa.func.count(), sa.func.min(Job.run_at))
+    .where(Job.status.in_(("queued", "running", "failed"))).group_by(Job.name, Job.status)).all()
+    gauges = []
+    for name, status, count, oldest in rows:
+        gauges.append(("job_queue_depth", count, {"job": name, "status": status}))
+        if status == "queued":
+            gauges.append(("job_queue_oldest_seconds", round(max((now - oldest).total_seconds(), 0.0), 3),
+            {"job": name}))
+    return gauges
+
+@click.command("run-worker")
+@click.option("--once", is_flag=True, help="Run the jobs that are due, then stop.")
+@click.option("--poll-interval", type=float, default=None,
+help="Seconds to wait when no job is due (default: JOB_POLL_INTERVAL).")
+@with_appcontext
+def run_worker(once, poll_interval):
+    """Runs queued background jobs until stopped with Ctrl-C or SIGTERM, which let the current job
+    finish first."""
+    stopping = []
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda signum, frame: stopping.append(signum))
+    try:
+        ran = work(once=once, poll_interval=poll_interval or current_app.config['JOB_POLL_INTERVAL'],
+        stop=lambda: bool(stopping))
+    finally:
+        db.session.remove()
+    print(f"Ran {ran} jobs.")
+
+def init_app(app):
+    """A function that adds 'flask run-worker' to 'app' and reports the queue in its metrics."""
+    app.cli.add_command(run_worker)
+    metrics.add_collector(queue_gauges)
+
+@handler("delete_account")
+def delete_account(username):
+    """Deletes a user that 'remove_account' has already marked as deleted, and their feedback in
+    batches of ACCOUNT_DELETE_BATCH_SIZE rows."""
+    User.delete_account(username, batch_size=current_app.config['ACCOUNT_DELETE_BATCH_SIZE'])
+    cache.invalidate_user(username)
+    feed.invalidate()
+
+def remove_account(username):
+    """A function that deletes the account of 'username' for the HTML and JSON routes alike and
+    returns True if there was such an account. With SOFT_DELETE on the account is only marked as
+    deleted. Otherwise an account with at least ACCOUNT_DELETE_BACKGROUND_THRESHOLD pieces of feedback
+    is marked as deleted in the same commit that queues a 'delete_account' job to remove the rows, so
+    nobody can log in as it or see its feedback while the job waits; smaller accounts are deleted at
+    once. An account already marked as deleted is left to its job or to 'flask purge-deleted'.
+    A deleted account's cached pages and sessions are dropped."""
+    threshold = current_app.config['ACCOUNT_DELETE_BACKGROUND_THRESHOLD']
+    if User.live().filter_by(username=username).first() is None:
+        return False
+    if current_app.config['SOFT_DELETE']:
+        deleted = User.soft_delete(username)
+    elif threshold and User.has_at_least_feedback(username, threshold):
+        enqueue("delete_account", username=username)
+        deleted = User.soft_delete(username)
+    else:
+        deleted = User.delete_account(username)
+    if deleted:
+        cache.invalidate_user(username)
+        feed.invalidate()
+        sessions.revoke_user_sessions(current_app, username)
+    return deleted
+
+@handler("import_feedback")
+def import_feedback(username, fmt):
+    """Imports feedback for 'username' from the NDJSON or CSV upload staged for the job (see
+    'bulk.stage_upload') and returns the number of rows imported and the errors, as
+    '/users/<username>/feedback/import' does. Each batch saves a checkpoint, so a retry carries on
+    after the last batch committed. The upload is deleted once it has all been imported."""
+    result = bulk.import_feedback(username, bulk.read_rows(bulk.staged_lines(g.job_id), fmt),
+    batch_size=current_app.config['IMPORT_BATCH_SIZE'], checkpoint=load_checkpoint(),
+    on_commit=save_checkpoint)
+    bulk.discard_upload(g.job_id)
+    db.session.commit()
+    return result
+
+@handler("purge_deleted")
+def purge_deleted():
+    """Permanently removes the users and feedback soft-deleted more than PURGE_AFTER seconds ago, in
+    batches of PURGE_BATCH_SIZE rows, and returns how many of each it removed."""
+    config = current_app.config
+    before = datetime.utcnow() - timedelta(seconds=config['PURGE_AFTER'])
+    #Feedback first, so a purged user's own batches only hold what was still shown.
+    feedback = Feedback.purge_deleted(before, config['PURGE_BATCH_SIZE'])
+    users = User.purge_deleted(before, config['PURGE_BATCH_SIZE'])
+    return {"users": users, "feedback": feedback}
@@ -0,0 +1,96 @@
+"""In-process metrics for the Commentator app. Counters and timings are kept in a single
+thread-safe registry so any part of the app can record them cheaply."""
+
+import threading
+
+class Metrics:
+    """A registry of named counters and timings. Each metric can carry labels (for example,
+    the name of a route or an operation), and each distinct set of labels is tracked separately."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._timings = {}
+        self._collectors = []
+
+    @staticmethod
+    def _key(name, labels):
+        return (name, tuple(sorted(labels.items())))
+
+    def increment(self, name, amount=1, **labels):
+        """A method that adds 'amount' to the counter 'name' for the given labels."""
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, seconds, **labels):
+        """A method that records one timing of 'seconds' for the timing 'name' with the given labels.
+        The registry keeps the count, the total, and the maximum of all observed timings."""
+        key = self._key(name, labels)
+        with self._lock:
+            count, total, maximum = self._timings.get(key, (0, 0.0, 0.0))
+            self._timings[key] = (count + 1, total + seconds, max(maximum, seconds))
+
+    def add_collector(self, collector):
+        """A method that registers 'collector', a function called each time the metrics are rendered
+        that returns a list of (name, value, labels) gauges measured at that moment, for values kept
+        outside this process such as the length of the job queue. A collector is only added once."""
+        with self._lock:
+            if collector not in self._collectors:
+                self._collectors.append(collector)
+
+    def snapshot(self):
+        """A method that returns a copy of every counter and timing as a dictionary with the keys
+        'counters' and 'timings'. Keys within each are (name, labels) pairs."""
+        with self._lock:
+            counters = dict(self._counters)
+            timings = {key: {"count": count, "sum": total, "max": maximum}
+            for key, (count, total, maximum) in self._timings.items()}
+        return {"counters": counters, "timings": timings}
+
+    def render_prometheus(self):
+        """A method that returns every metric in the Prometheus text format. Counters are reported as
+        counters, and each timing as a summary (its '_count' and '_sum') plus its maximum. The gauges of
+        every collector come last."""
+        snapshot = self.snapshot()
+        lines = []
+        for name in sorted({name for name, _ in snapshot["counters"]}):
+            lines.append(f"# TYPE {name} counter")
+            for (metric, labels), value in sorted(snapshot["counters"].items()):
+                if metric == name:
+                    lines.append(f"{name}{_format_labels(labels)} {value}")
+        for name in sorted({name for name, _ in snapshot["timings"]}):
+            lines.append(f"# TYPE {name} summary")
+            for (metric, labels), timing in sorted(snapshot["timings"].items()):
+                if metric == name:
+                    lines.append(f"{name}_count{_format_labels(labels)} {timing['count']}")
+                    lines.append(f"{name}_sum{_format_labels(labels)} {timing['sum']:.6f}")
+            lines.append(f"# TYPE {name}_max gauge")
+            for (metric, labels), timing in sorted(snapshot["timings"].items()):
+                if metric == name:
+                    lines.append(f"{name}_max{_format_labels(labels)} {timing['max']:.6f}")
+        gauges = {}
+        for collector in list(self._collectors):
+            for name, value, labels in collector():
+                gauges.setdefault(name, []).append((tuple(sorted(labels.items())), value))
+        for name in sorted(gauges):
+            lines.append(f"# TYPE {name} gauge")
+            for labels, value in sorted(gauges[name]):
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        """A method that clears every counter and timing."""
+        with self._lock:
+            self._counters.clear()
+            self._timings.clear()
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels) + "}"
+
+metrics = Metrics()
@@ -0,0 +1,158 @@
+"""Schema migrations for the Commentator app. Each migration is a function that changes the schema
+of an existing database by one step, and the 'schema_migrations' table records which of them have
+already been applied. Run 'flask upgrade-db' to bring a database up to date.
+
+To change the schema, change the models in 'models.py' and add a new migration at the bottom of
+this file that makes the same change to an existing database."""
+
+from datetime import datetime
+
+import sqlalchemy as sa
+
+MIGRATIONS = []
+
+def migration(version, description):
+    """A decorator that registers a function as the migration to schema version 'version'. The
+    function is called with a connection inside the transaction that applies it."""
+    def register(func):
+        MIGRATIONS.append((version, description, func))
+        MIGRATIONS.sort(key=lambda item: item[0])
+        return func
+    return register
+
+schema_migrations = sa.Table("schema_migrations", sa.MetaData(),
+    sa.Column("version", sa.Integer, primary_key=True),
+    sa.Column("description", sa.Text, nullable=False),
+    sa.Column("applied_at", sa.DateTime, nullable=False))
+
+def applied_versions(connection):
+    """A function that returns the set of migration versions already applied to the database."""
+    schema_migrations.create(connection, checkfirst=True)
+    return {row.version for row in connection.execute(sa.select(schema_migrations.c.version))}
+
+def upgrade(engine, target=None, log=print):
+    """A function that applies, in order and each in its own transaction, every migration up to
+    'target' (or all of them) that has not been applied to the database behind 'engine' yet. It
+    returns the list of versions it applied."""
+    with engine.begin() as connection:
+        applied = applied_versions(connection)
+        #A database made by 'db.create_all()' before migrations existed already has the initial schema.
+        if not applied and sa.inspect(connection).has_table("users"):
+            _record(connection, *MIGRATIONS[0][:2])
+            applied.add(MIGRATIONS[0][0])
+
+    newly_applied = []
+    for version, description, func in MIGRATIONS:
+        if version in applied or (target is not None and version > target):
+            continue
+        with engine.begin() as connection:
+            func(connection)
+            _record(connection, version, description)
+        log(f"Applied migration {version}: {description}")
+        newly_applied.append(version)
+    return newly_applied
+
+def _record(connection, version, description):
+    connection.execute(schema_migrations.insert().values(version=version, description=description,
+    applied_at=datetime.utcnow()))
+
+@migration(1, "create users and feedback tables")
+def create_tables(connection):
+    metadata = sa.MetaData()
+    sa.Table("users", metadata,
+        sa.Column("username", sa.String(20), primary_key=True),
+        sa.Column("password", sa.Text, nullable=False),
+        sa.Column("email", sa.String(50), nullable=False, unique=True),
+        sa.Column("first_name", sa.String(30), nullable=False),
+        sa.Column("last_name", sa.String(30), nullable=False))
+    sa.Table("feedback", metadata,
+        sa.Column("id", sa.Integer, primary_key=True, autoincrement=True),
+        sa.Column("title", sa.String(100), nullable=False),
+        sa.Column("content", sa.Text, nullable=False),
+        sa.Column("username", sa.String(20), sa.ForeignKey("users.username"), nullable=False))
+    metadata.create_all(connection)
+
+@migration(2, "index feedback by username and id")
+def index_feedback_username(connection):
+    #Serves the foreign key lookups when a user is deleted as well as the per-user listing, whose
+    #keyset pagination filters on username and orders by id.
+    connection.execute(sa.text("CREATE INDEX ix_feedback_username_id ON feedback (username, id)"))
+
+@migration(3, "delete feedback along with its user in the database")
+def cascade_feedback_deletes(connection):
+    #SQLite cannot alter a foreign key in place; 'User.delete_account' deletes feedback explicitly
+    #anyway, so the cascade is only added where it can be.
+    if connection.dialect.name != "postgresql":
+        return
+    for foreign_key in sa.inspect(connection).get_foreign_keys("feedback"):
+        if foreign_key["referred_table"] == "users":
+            connection.execute(sa.text(f'ALTER TABLE feedback DROP CONSTRAINT "{foreign_key["name"]}"'))
+    connection.execute(sa.text("ALTER TABLE feedback ADD CONSTRAINT feedback_username_fkey "
+    "FOREIGN KEY (username) REFERENCES users (username) ON DELETE CASCADE"))
+
+@migration(4, "add version columns to users and feedback")
+def add_versions(connection):
+    for table in ("users", "feedback"):
+        connection.execute(sa.text(f"ALTER TABLE {table} ADD COLUMN version INTEGER NOT NULL DEFAULT 1"))
+
+@migration(5, "add full-text search over feedback")
+def add_feedback_search(connection):
+    from search import create_search_index
+    create_search_index(connection, backfill=True)
+
+@migration(6, "add server-side sessions")
+def add_sessions(connection):
+    metadata = sa.MetaData()
+    sa.Table("sessions", metadata,
+        sa.Column("id", sa.String(32), primary_key=True),
+        sa.Column("username", sa.String(20), nullable=True, index=True),
+        sa.Column("data", sa.Text, nullable=False),
+        sa.Column("expires_at", sa.DateTime, nullable=False, index=True))
+    metadata.create_all(connection)
+
+@migration(7, "count each user's feedback")
+def add_feedback_counts(connection):
+    connection.execute(sa.text("ALTER TABLE users ADD COLUMN feedback_count INTEGER NOT NULL DEFAULT 0"))
+    connection.execute(sa.text("UPDATE users SET feedback_count = "
+    "(SELECT COUNT(*) FROM feedback WHERE feedback.username = users.username)"))
+
+@migration(8, "add a queue of background jobs")
+def add_jobs(connection):
+    metadata = sa.MetaData()
+    jobs = sa.Table("jobs", metadata,
+        sa.Column("id", sa.Integer, primary_key=True, autoincrement=True),
+        sa.Column("name", sa.String(50), nullable=False),
+        sa.Column("payload", sa.Text, nullable=False),
+        sa.Column("status", sa.String(10), nullable=False),
+        sa.Column("attempts", sa.Integer, nullable=False, server_default="0"),
+        sa.Column("enqueued_at", sa.DateTime, nullable=False),
+        sa.Column("run_at", sa.DateTime, nullable=False),
+        sa.Column("started_at", sa.DateTime, nullable=True),
+        sa.Column("finished_at", sa.DateTime, nullable=True),
+        sa.Column("last_error", sa.Text, nullable=True),
+        sa.Column("result", sa.Text, nullable=True))
+    sa.Index("ix_jobs_status_run_at", jobs.c.status, jobs.c.run_at)
+    metadata.create_all(connection)
+
+@migration(9, "soft-delete users and feedback")
+def add_soft_deletes(connection):
+    for table in ("users", "feedback"):
+        connection.execute(sa.text(f"ALTER TABLE {table} ADD COLUMN deleted_at TIMESTAMP"))
+    #Both Postgres and SQLite support partial indexes, which only hold the rows matching their WHERE.
+    connection.execute(sa.text("CREATE INDEX ix_users_deleted_at ON users (deleted_at) "
+    "WHERE deleted_at IS NOT NULL"))
+    connection.execute(sa.text("CREATE INDEX ix_feedback_live_username_id ON feedback (username, id, title) "
+    "WHERE deleted_at IS NULL"))
+    connection.execute(sa.text("CREATE INDEX ix_feedback_deleted_at ON feedback (deleted_at) "
+    "WHERE deleted_at IS NOT NULL"))
+
+@migration(10, "stage background imports in the database and checkpoint jobs")
+def add_import_chunks(connection):
+    connection.execute(sa.text("ALTER TABLE jobs ADD COLUMN checkpoint TEXT"))
+    metadata = sa.MetaData()
+    sa.Table("jobs", metadata, autoload_with=connection)
+    sa.Table("import_chunks", metadata,
+        sa.Column("job_id", sa.Integer, sa.ForeignKey("jobs.id", ondelete="CASCADE"), primary_key=True),
+        sa.Column("seq", sa.Integer, primary_key=True),
+        sa.Column("data", sa.Text, nullable=False))
+    metadata.tables["import_chunks"].create(connection)
@@ -1,34 +1,122 @@
 """Models for users and feedback for the Commentator app."""
 
+import base64
+import time
+import zlib
+from datetime import datetime
 from flask import Flask
-from flask_sqlalchemy import SQLAlchemy
-from flask_bcrypt import Bcrypt
+import sqlalchemy as sa
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.orm import selectinload, joinedload, lazyload, raiseload, undefer
+from hashing import hasher
+from metrics import metrics
+from replicas import RoutingSQLAlchemy
 
-db = SQLAlchemy()
-bcrypt = Bcrypt()
+#Routes the reads of read-only requests to replicas when there are any (see 'replicas.py').
+db = RoutingSQLAlchemy()
+
+#Ways of loading the authors of a list of feedback, chosen per route with AUTHOR_LOADING (see 'config.py').
+AUTHOR_LOADERS = {"selectin": selectinload, "joined": joinedload, "lazy": lazyload, "raise": raiseload}
 
 def connect_db(app):
     """An function that connects the app in 'app.py' to the application's database."""
     db.app = app
     db.init_app(app)
+    CompressedText.threshold = app.config.get("FEEDBACK_COMPRESS_THRESHOLD")
+
+class TimedQueuePool(QueuePool):
+    """A connection pool that records how long each checkout waits for a connection (including
+    opening a new one) as the 'db_pool_checkout_seconds' metric, and counts checkouts that give up
+    after 'pool_timeout' as 'db_pool_timeouts_total'. Long waits mean the pool is too small for the
+    number of threads using it."""
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except PoolTimeoutError:
+            metrics.increment("db_pool_timeouts_total")
+            raise
+        finally:
+            metrics.observe("db_pool_checkout_seconds", time.perf_counter() - start)
+
+def dispose_engine(app):
+    """A function that closes every pooled database connection of the app (to the primary and to any
+    replicas), so that a forked worker process opens its own connections instead of sharing its
+    parent's."""
+    with app.app_context():
+        for bind in [None] + list(app.config.get("SQLALCHEMY_BINDS") or ()):
+            db.get_engine(app, bind).dispose()
+
+class CompressedText(sa.types.TypeDecorator):
+    """A text column that stores values of more than 'threshold' bytes compressed with zlib, as
+    'zlib:' followed by the compressed bytes in base64, and gives them back as ordinary text. Values
+    that would not get smaller are stored as they are, and so is everything while 'threshold' is
+    None, so compression can be turned on or off at any time and old rows are read either way. A
+    value that happens to start with 'zlib:' is always compressed, so it is never misread."""
+
+    impl = sa.Text
+    cache_ok = True
+    prefix = "zlib:"
+    #Set from FEEDBACK_COMPRESS_THRESHOLD by 'connect_db'.
+    threshold = None
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        escape = value.startswith(self.prefix)
+        data = value.encode()
+        if not escape and (self.threshold is None or len(data) <= self.threshold):
+            return value
+        compressed = self.prefix + base64.b64encode(zlib.compress(data)).decode("ascii")
+        return compressed if escape or len(compressed) < len(data) else value
+
+    def process_result_value(self, value, dialect):
+        if value is None or not value.startswith(self.prefix):
+            return value
+        return zlib.decompress(base64.b64decode(value[len(self.prefix):])).decode()
 
 class User(db.Model):
     """A user of the Commentator app."""
     __tablename__ = "users"
+    #Lets the purge find soft-deleted users without looking at any others.
+    __table_args__ = (db.Index("ix_users_deleted_at", "deleted_at",
+    sqlite_where=sa.text("deleted_at IS NOT NULL"), postgresql_where=sa.text("deleted_at IS NOT NULL")),)
 
     username=db.Column(db.String(20), primary_key=True)
     password=db.Column(db.Text, nullable=False)
     email=db.Column(db.String(50), nullable=False, unique=True)
     first_name=db.Column(db.String(30), nullable=False)
     last_name=db.Column(db.String(30), nullable=False)
+    #Bumped whenever the user or their feedback changes, so pages about the user can be revalidated
+    #by comparing versions instead of loading and rendering everything again.
+    version=db.Column(db.Integer, nullable=False, default=1, server_default="1")
+    #How much feedback the user has written, kept up to date by every route that adds or deletes
+    #feedback (through 'bump_version') so it never has to be counted.
+    feedback_count=db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    #When the user was soft-deleted (see 'soft_delete'), or None for a current user.
+    deleted_at=db.Column(db.DateTime, nullable=True)
+
+    @classmethod
+    def live(cls):
+        """A class method on the User model that returns a query of the users that have not been
+        deleted."""
+
+        return cls.query.filter(cls.deleted_at.is_(None))
+
+    @hybrid_property
+    def display_name(self):
+        """The user's full name, as shown next to their feedback. It can be used in queries too."""
+        return self.first_name + " " + self.last_name
 
     @classmethod
     def register(cls, username, password, email, first_name, last_name):
         """A class method on the User model that returns an instance of the User class
         with a hashed password."""
 
-        hashed_password = bcrypt.generate_password_hash(password)
-        utf8_hash = hashed_password.decode("utf8")
+        utf8_hash = hasher.generate_password_hash(password)
 
         return cls(username=username, password=utf8_hash, email=email, 
         first_name=first_name, last_name=last_name)
@@ -39,22 +127,248 @@ class User(db.Model):
         against any username that matches the entered username in the database and its password.
         If the username exists in the database and its user's hashed password matches the hash in the
         database, the method returns the instance of the user. If either condition is not true, the
-        method returns False"""
+        method returns False. If the stored hash was made with an outdated bcrypt work factor, it is
+        replaced with a new hash at the current work factor before the user is returned. An unknown
+        username still costs one bcrypt check, so it takes as long as a wrong password."""
 
-        user = User.query.filter_by(username=username).first()
-        if user and bcrypt.check_password_hash(user.password, password):
+        user = User.live().filter_by(username=username).first()
+        if user is None:
+            return hasher.check_dummy(password)
+        if hasher.check_password_hash(user.password, password):
+            if hasher.needs_rehash(user.password):
+                user.password = hasher.generate_password_hash(password)
+                db.session.commit()
             return user
         else:
             return False
     
-    feedback=db.relationship("Feedback", cascade="all, delete", backref="user")
+    @classmethod
+    def bump_version(cls, username, feedback_delta=0):
+        """A class method on the User model that increments the version of the user with 'username'
+        in the database (as part of the current transaction) without loading the user. Routes that
+        add or delete feedback pass the change in the amount of feedback as 'feedback_delta', which
+        is added to the user's feedback count in the same statement."""
+
+        values = {cls.version: cls.version + 1}
+        if feedback_delta:
+            values[cls.feedback_count] = cls.feedback_count + feedback_delta
+        cls.query.filter_by(username=username).update(values, synchronize_session=False)
+
+    @classmethod
+    def current_version(cls, username):
+        """A class method on the User model that returns the version of the user with 'username', or
+        None if there is no such user (or they were deleted), loading nothing but the version."""
+
+        return db.session.query(cls.version).filter_by(username=username, deleted_at=None).scalar()
+
+    @classmethod
+    def delete_account(cls, username, batch_size=None):
+        """A class method on the User model that deletes the user with 'username' and all of their
+        feedback with bulk DELETE statements, without loading any of the rows into the session. If
+        'batch_size' is given, feedback is deleted and committed at most that many rows at a time so
+        a huge account never holds its locks for long. It returns True if there was such a user."""
+
+        if batch_size:
+            batch = db.select(Feedback.id).where(Feedback.username == username).limit(batch_size)
+            while Feedback.query.filter(Feedback.id.in_(batch)).delete(synchronize_session=False):
+                db.session.commit()
+        else:
+            Feedback.query.filter_by(username=username).delete(synchronize_session=False)
+        deleted = cls.query.filter_by(username=username).delete(synchronize_session=False)
+        db.session.commit()
+        return bool(deleted)
+
+    @classmethod
+    def soft_delete(cls, username):
+        """A class method on the User model that marks the user with 'username' as deleted with a
+        single UPDATE, which hides them and all of their feedback at once however much they have
+        written. 'purge_deleted' removes the rows for good later. It returns True if there was such a
+        user that had not been deleted yet."""
+
+        deleted = cls.query.filter_by(username=username, deleted_at=None).update(
+        {cls.deleted_at: datetime.utcnow(), cls.version: cls.version + 1}, synchronize_session=False)
+        db.session.commit()
+        return bool(deleted)
+
+    @classmethod
+    def purge_deleted(cls, before, batch_size):
+        """A class method on the User model that permanently deletes the users soft-deleted before
+        'before', with all of their feedback, committing at most 'batch_size' rows at a time. It
+        returns the number of users deleted."""
+
+        usernames = [row.username for row in db.session.query(cls.username).filter(cls.deleted_at < before)]
+        for username in usernames:
+            cls.delete_account(username, batch_size=batch_size)
+        return len(usernames)
+
+    @classmethod
+    def get_many(cls, usernames):
+        """A class method on the User model that returns a dictionary of the users with 'usernames',
+        loaded with one query however many there are. Usernames with no current user are left out."""
+
+        usernames = set(usernames)
+        if not usernames:
+            return {}
+        return {user.username: user for user in cls.live().filter(cls.username.in_(usernames))}
+
+    @classmethod
+    def has_at_least_feedback(cls, username, count):
+        """A class method on the User model that returns True if the user with 'username' has written
+        at least 'count' pieces of feedback. It stops looking after 'count' rows instead of counting
+        them all."""
+
+        return db.session.query(Feedback.id).filter_by(username=username).offset(count - 1).limit(1
+        ).first() is not None
+
+    #passive_deletes leaves removing a deleted user's feedback to the database (or to
+    #'delete_account') instead of loading every row to delete it one by one.
+    feedback=db.relationship("Feedback", cascade="all, delete", passive_deletes=True, backref="user")
 
 
 class Feedback(db.Model):
     """A comment in the Commentator app."""
     __tablename__ = "feedback"
+    #The partial indexes leave out soft-deleted rows: a user's listing reads the ids and titles of
+    #their current feedback straight from the index, and the purge only looks at deleted rows.
+    __table_args__ = (db.Index("ix_feedback_username_id", "username", "id"),
+    db.Index("ix_feedback_live_username_id", "username", "id", "title",
+    sqlite_where=sa.text("deleted_at IS NULL"), postgresql_where=sa.text("deleted_at IS NULL")),
+    db.Index("ix_feedback_deleted_at", "deleted_at",
+    sqlite_where=sa.text("deleted_at IS NOT NULL"), postgresql_where=sa.text("deleted_at IS NOT NULL")))
 
     id=db.Column(db.Integer, primary_key=True, autoincrement=True)
     title=db.Column(db.String(100), nullable=False)
-    content=db.Column(db.Text, nullable=False)
-    username=db.Column(db.String(20), db.ForeignKey("users.username"), nullable=False)
\ No newline at end of file
+    #Deferred, so lists of feedback never load what may be a long text they do not show; routes that
+    #show it ask for it with 'with_author(content=True)'.
+    content=db.deferred(db.Column(CompressedText, nullable=False))
+    username=db.Column(db.String(20), db.ForeignKey("users.username", ondelete="CASCADE"), nullable=False)
+    #Incremented by SQLAlchemy on every update of the row.
+    version=db.Column(db.Integer, nullable=False, default=1, server_default="1")
+    #When the feedback was soft-deleted, or None if it is still shown.
+    deleted_at=db.Column(db.DateTime, nullable=True)
+
+    __mapper_args__ = {"version_id_col": version}
+
+    @classmethod
+    def live(cls):
+        """A class method on the Feedback model that returns a query of the feedback that has not been
+        deleted and whose author has not been deleted either."""
+
+        return cls.query.join(User, User.username == cls.username).filter(cls.deleted_at.is_(None),
+        User.deleted_at.is_(None))
+
+    @classmethod
+    def purge_deleted(cls, before, batch_size):
+        """A class method on the Feedback model that permanently deletes the feedback soft-deleted
+        before 'before' with bulk DELETE statements of at most 'batch_size' rows, each committed on its
+        own so no lock is held for long. It returns the number of rows deleted."""
+
+        batch = db.select(cls.id).where(cls.deleted_at < before).limit(batch_size)
+        total = 0
+        while True:
+            count = cls.query.filter(cls.id.in_(batch)).delete(synchronize_session=False)
+            db.session.commit()
+            if not count:
+                return total
+            total += count
+
+    @classmethod
+    def with_author(cls, strategy="selectin", content=False):
+        """A class method on the Feedback model that returns a query of feedback that loads the author
+        of each row ('feedback.user') with 'strategy': 'selectin' (one more query for all the authors
+        of the rows), 'joined' (in the same query), 'lazy' (a query per author the first time one is
+        used), or 'raise' (an error if one is used). The content of each row is only loaded in the
+        same query if 'content' is True. Deleted feedback is left out."""
+
+        query = cls.live().options(AUTHOR_LOADERS[strategy](cls.user))
+        return query.options(undefer(cls.content)) if content else query
+
+    @classmethod
+    def with_author_names(cls):
+        """A class method on the Feedback model that returns a query of (id, title, username,
+        author_name) rows, with the display name of each row's author joined in. Nothing but those
+        columns is loaded, which makes it the cheapest way to list feedback with its authors. Deleted
+        feedback is left out."""
+
+        return db.session.query(cls.id, cls.title, cls.username, User.display_name.label("author_name")
+        ).join(User, User.username == cls.username).filter(cls.deleted_at.is_(None),
+        User.deleted_at.is_(None))
+
+    @classmethod
+    def recent(cls, before=None, limit=20):
+        """A class method on the Feedback model that returns one page of everyone's feedback, newest
+        first, as a list of (id, title, username, author_name, author_feedback_count) rows plus the id
+        to pass as 'before' for the next page (None if this is the last page). Only rows with an id
+        less than 'before' are returned, so every page is read straight off the primary key."""
+
+        query = cls.with_author_names().add_columns(User.feedback_count.label("author_feedback_count"))
+        if before is not None:
+            query = query.filter(cls.id < before)
+        rows = query.order_by(cls.id.desc()).limit(limit + 1).all()
+        if len(rows) > limit:
+            rows = rows[:limit]
+            return rows, rows[-1].id
+        return rows, None
+
+    @classmethod
+    def page_for_user(cls, username, after=None, limit=20):
+        """A class method on the Feedback model that returns one page of a user's feedback, oldest
+        first, as a list of (id, title) rows plus the id to pass as 'after' for the next page (None if
+        this is the last page). Only rows with an id greater than 'after' are returned, so each page
+        costs the same no matter how far into the list it is."""
+
+        query = db.session.query(cls.id, cls.title).filter(cls.username == username,
+        cls.deleted_at.is_(None))
+        if after is not None:
+            query = query.filter(cls.id > after)
+        #One extra row is fetched to tell whether there is another page without a COUNT.
+        rows = query.order_by(cls.id).limit(limit + 1).all()
+        if len(rows) > limit:
+            rows = rows[:limit]
+            return rows, rows[-1].id
+        return rows, None
+
+
+class StoredSession(db.Model):
+    """A login session kept on the server, used when the app's SESSION_BACKEND is 'sql'. The browser
+    only holds the session's random id."""
+    __tablename__ = "sessions"
+
+    id=db.Column(db.String(32), primary_key=True)
+    username=db.Column(db.String(20), nullable=True, index=True)
+    data=db.Column(db.Text, nullable=False)
+    expires_at=db.Column(db.DateTime, nullable=False, index=True)
+
+class Job(db.Model):
+    """A piece of slow work queued to run outside of a request by 'flask run-worker' (see 'jobs.py').
+    'payload' holds the job's arguments as JSON, and 'result' what it returned."""
+    __tablename__ = "jobs"
+    #The worker looks for queued jobs that are due, oldest first.
+    __table_args__ = (db.Index("ix_jobs_status_run_at", "status", "run_at"),)
+
+    id=db.Column(db.Integer, primary_key=True, autoincrement=True)
+    name=db.Column(db.String(50), nullable=False)
+    payload=db.Column(db.Text, nullable=False)
+    #'queued', 'running', 'done', or 'failed'.
+    status=db.Column(db.String(10), nullable=False, default="queued")
+    attempts=db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    enqueued_at=db.Column(db.DateTime, nullable=False)
+    #When the job is next due; retries are pushed back from the time of the failure.
+    run_at=db.Column(db.DateTime, nullable=False)
+    started_at=db.Column(db.DateTime, nullable=True)
+    finished_at=db.Column(db.DateTime, nullable=True)
+    last_error=db.Column(db.Text, nullable=True)
+    result=db.Column(db.Text, nullable=True)
+    #How far a job that works in steps has got, as JSON. It is saved along with each step, so a retry
+    #carries on from the last step that was committed (see 'jobs.save_checkpoint').
+    checkpoint=db.Column(db.Text, nullable=True)
+
+class ImportChunk(db.Model):
+    """A piece of a file uploaded for a background import, kept in the database so whichever worker
+    runs the import can read it. Each piece holds whole lines of the file, and the pieces of the
+    upload of the job 'job_id' are numbered in order by 'seq'."""
+    __tablename__ = "import_chunks"
+
+    job_id=db.Column(db.Integer, db.ForeignKey("jobs.id", ondelete="CASCADE"), primary_key=True)
+    seq=db.Column(db.Integer, primary_key=True)
+    data=db.Column(db.Text, nullable=False)
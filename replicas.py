@@ -0,0 +1,161 @@
+"""Read replicas for the Commentator app. Most requests only read ('GET /users/<username>',
+'GET /feedback/<id>/update'), so their queries can be spread over copies of the database, leaving
+the primary for writes.
+
+Replicas are listed in DATABASE_REPLICA_URLS and become the Flask-SQLAlchemy binds 'replica_0',
+'replica_1', and so on. The app's database session sends a query to a replica only when all of
+these hold; otherwise it goes to the primary:
+- the request is a GET, HEAD, or OPTIONS request, and nothing has been written during it;
+- the query is a plain SELECT (not SELECT ... FOR UPDATE) and the session is not flushing;
+- the client has not written anything in the last REPLICA_STICKY_SECONDS, so a client that has
+  just added or edited feedback always sees its own change (tracked in its session);
+- the replica is no more than REPLICA_MAX_LAG seconds behind the primary. Each replica's lag is
+  measured at most every REPLICA_LAG_CHECK_INTERVAL seconds, and one that cannot be reached is
+  passed over until its next check.
+
+Each request reads from one replica, chosen in turn when it first reads, so all of its queries see
+the same copy of the data and it holds one replica connection at most. Requests that had to read
+from the primary because no replica was fit are counted as 'db_replica_fallbacks_total', and
+'/metrics' reports each replica's last measured lag as 'db_replica_lag_seconds'. The JSON API
+reads through the same session, so its GET requests use the replicas too."""
+
+import itertools
+import threading
+import time
+
+import sqlalchemy as sa
+from flask import current_app, g, has_app_context, has_request_context, request, session
+from flask_sqlalchemy import SQLAlchemy, SignallingSession, get_state
+from sqlalchemy import orm
+
+from metrics import metrics
+
+READ_METHODS = ("GET", "HEAD", "OPTIONS")
+
+def measure_lag(engine):
+    """A function that returns how many seconds the database behind 'engine' is behind its primary.
+    A Postgres standby that has replayed everything it has received counts as not behind at all;
+    databases without replication (a primary, or a copied SQLite file) are never behind."""
+    with engine.connect() as connection:
+        if connection.dialect.name != "postgresql":
+            return 0.0
+        return float(connection.execute(sa.text("SELECT CASE WHEN NOT pg_is_in_recovery() "
+        "OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+        "ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END")).scalar() or 0.0)
+
+class ReplicaRouter:
+    """Chooses a replica for each read from the binds 'bind_keys' of 'app', in turn, passing over any
+    that are more than 'max_lag' seconds behind or cannot be reached. Lag is measured with
+    'measure' at most every 'check_interval' seconds per replica."""
+
+    def __init__(self, app, bind_keys, max_lag=5.0, check_interval=5.0, measure=measure_lag):
+        self.app = app
+        self.bind_keys = list(bind_keys)
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.measure = measure
+        self._cycle = itertools.cycle(self.bind_keys)
+        self._lock = threading.Lock()
+        #Maps each bind key to its last measured lag (None if it could not be reached) and when that was.
+        self._lags = {}
+
+    def engine(self, key):
+        return get_state(self.app).db.get_engine(self.app, bind=key)
+
+    def lag(self, key):
+        """A method that returns the lag of the replica 'key', measuring it again if the last
+        measurement is more than 'check_interval' seconds old, or None if it cannot be reached."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._lags.get(key)
+        if entry is not None and now - entry[1] < self.check_interval:
+            return entry[0]
+        try:
+            lag = self.measure(self.engine(key))
+        except sa.exc.SQLAlchemyError as error:
+            self.app.logger.warning("Read replica %s cannot be reached: %s", key, error)
+            lag = None
+        with self._lock:
+            self._lags[key] = (lag, now)
+        return lag
+
+    def read_engine(self):
+        """A method that returns the engine of the next replica fit to read from, or None if every
+        replica is too far behind or cannot be reached."""
+        for _ in self.bind_keys:
+            with self._lock:
+                key = next(self._cycle)
+            lag = self.lag(key)
+            if lag is not None and lag <= self.max_lag:
+                return self.engine(key)
+        metrics.increment("db_replica_fallbacks_total")
+        return None
+
+    def lag_gauges(self):
+        """A metrics collector that reports the last measured lag of each replica that could be
+        reached. It reports nothing for an app other than this router's."""
+        if not has_app_context() or current_app.extensions.get("replicas") is not self:
+            return []
+        with self._lock:
+            lags = dict(self._lags)
+        return [("db_replica_lag_seconds", round(lag, 3), {"replica": key})
+        for key, (lag, _) in sorted(lags.items()) if lag is not None]
+
+def may_read_from_replica():
+    """A function that returns True if the queries of the current request may go to a replica: it is
+    a request that only reads, nothing has been written during it, and the client has not written
+    anything recently."""
+    return (has_request_context() and request.method in READ_METHODS and not g.get("database_written")
+    and session.get("_primary_until", 0) <= time.time())
+
+def is_read(clause):
+    """A function that returns True if 'clause' is a statement that only reads."""
+    if isinstance(clause, sa.sql.expression.TextClause):
+        return clause.text.lstrip()[:6].upper() == "SELECT"
+    return bool(getattr(clause, "is_select", False)) and getattr(clause, "_for_update_arg", None) is None
+
+class RoutingSession(SignallingSession):
+    """The app's database session. It sends the reads of read-only requests to a replica when the
+    app has any, the same one for the whole request (see the module docstring), and notes every
+    write so the client reads from the primary for a while afterward."""
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        router = current_app.extensions.get("replicas") if has_app_context() else None
+        if router is not None and has_request_context():
+            if self._flushing or (clause is not None and not is_read(clause)):
+                g.database_written = True
+            elif clause is not None and may_read_from_replica():
+                if "replica_engine" not in g:
+                    g.replica_engine = router.read_engine()
+                if g.replica_engine is not None:
+                    return g.replica_engine
+        return super().get_bind(mapper, clause)
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy with 'RoutingSession' as its session."""
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+def _stick_to_primary(response):
+    if g.get("database_written"):
+        session["_primary_until"] = time.time() + current_app.config.get("REPLICA_STICKY_SECONDS", 10)
+    return response
+
+def init_app(app):
+    """A function that adds the replicas in DATABASE_REPLICA_URLS to 'app' as database binds and
+    routes reads to them. It does nothing if there are none."""
+    urls = app.config.get("DATABASE_REPLICA_URLS") or []
+    if not urls:
+        return
+    binds = dict(app.config.get("SQLALCHEMY_BINDS") or {})
+    keys = []
+    for number, url in enumerate(urls):
+        keys.append(f"replica_{number}")
+        binds[keys[-1]] = url
+    app.config["SQLALCHEMY_BINDS"] = binds
+    router = app.extensions["replicas"] = ReplicaRouter(app, keys,
+    max_lag=app.config.get("REPLICA_MAX_LAG", 5.0),
+    check_interval=app.config.get("REPLICA_LAG_CHECK_INTERVAL", 5.0))
+    app.after_request(_stick_to_primary)
+    metrics.add_collector(router.lag_gauges)
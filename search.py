@@ -0,0 +1,130 @@
+"""Full-text search over feedback for the Commentator app.
+
+On Postgres, each piece of feedback has a 'search_vector' tsvector column with a GIN index on it.
+On SQLite (used for local tests), an FTS5 table 'feedback_fts' holds the same text, keyed by the
+feedback's id. Neither is part of the Feedback model, so ordinary feedback queries never load them;
+'index_feedback' keeps them up to date whenever feedback is added or edited."""
+
+import sqlalchemy as sa
+
+from models import db, Feedback
+
+def create_search_index(connection, backfill=False):
+    """A function that adds the search column and its GIN index (Postgres) or the FTS5 table and
+    the trigger that removes deleted feedback from it (SQLite) to a database that has a feedback
+    table. If 'backfill' is True, feedback already in the table is indexed too."""
+    if connection.dialect.name == "postgresql":
+        connection.execute(sa.text("ALTER TABLE feedback ADD COLUMN search_vector tsvector"))
+        if backfill:
+            backfill_search_index(connection)
+        connection.execute(sa.text("CREATE INDEX ix_feedback_search_vector ON feedback "
+        "USING gin (search_vector)"))
+    elif connection.dialect.name == "sqlite":
+        connection.execute(sa.text("CREATE VIRTUAL TABLE IF NOT EXISTS feedback_fts USING "
+        "fts5(title, content, tokenize='porter unicode61')"))
+        connection.execute(sa.text("CREATE TRIGGER IF NOT EXISTS feedback_fts_delete AFTER DELETE "
+        "ON feedback BEGIN DELETE FROM feedback_fts WHERE rowid = old.id; END"))
+        if backfill:
+            backfill_search_index(connection)
+
+def backfill_search_index(connection, batch_size=1000):
+    """A function that indexes the feedback already in the table, 'batch_size' rows at a time. The
+    rows are read through the Feedback table so compressed content is indexed as the text it holds."""
+    table = Feedback.__table__
+    result = connection.execution_options(stream_results=True).execute(
+    sa.select(table.c.id, table.c.title, table.c.content))
+    for rows in result.partitions(batch_size):
+        for statement, params in index_statements(rows, connection.dialect.name):
+            connection.execute(statement, params)
+
+def drop_search_index(connection):
+    """A function that removes the SQLite FTS5 table, which is not dropped along with the feedback
+    table the way the Postgres column is."""
+    if connection.dialect.name == "sqlite":
+        connection.execute(sa.text("DROP TABLE IF EXISTS feedback_fts"))
+
+#Keeps 'db.create_all()' and 'db.drop_all()' (as used by the tests) in step with the search index.
+sa.event.listen(Feedback.__table__, "after_create",
+    lambda target, connection, **kwargs: create_search_index(connection))
+sa.event.listen(Feedback.__table__, "before_drop",
+    lambda target, connection, **kwargs: drop_search_index(connection))
+
+def index_feedback(feedback):
+    """A function that updates the search index for 'feedback' (which must have been flushed, so it
+    has an id) as part of the current transaction."""
+    index_rows([(feedback.id, feedback.title, feedback.content)])
+
+def index_rows(rows):
+    """A function that updates the search index for a list of (id, title, content) rows of feedback
+    as part of the current transaction, in one batch of statements."""
+    for statement, params in index_statements(rows, db.engine.dialect.name):
+        db.session.execute(statement, params)
+
+def index_statements(rows, dialect_name):
+    """A function that returns the (statement, parameters) pairs that index a list of (id, title,
+    content) rows of feedback on a database of the dialect 'dialect_name', each run once with a list
+    of parameters. They can be run on any connection."""
+    if not rows:
+        return []
+    params = [{"id": feedback_id, "title": title, "content": content, "text": f"{title} {content}"}
+    for feedback_id, title, content in rows]
+    if dialect_name == "postgresql":
+        return [(sa.text("UPDATE feedback SET search_vector = to_tsvector('english', :text) "
+        "WHERE id = :id"), params)]
+    return [(sa.text("DELETE FROM feedback_fts WHERE rowid = :id"), params),
+    (sa.text("INSERT INTO feedback_fts (rowid, title, content) VALUES (:id, :title, :content)"), params)]
+
+def _fts5_query(text):
+    """A function that turns free text into an FTS5 query matching every word in it, quoting each
+    word so punctuation in the text cannot be read as query syntax."""
+    words = [word.replace('"', '""') for word in text.split()]
+    return " ".join(f'"{word}"' for word in words)
+
+def parse_cursor(cursor):
+    """A function that reads an 'after' cursor of the form '<score>:<id>' as made by
+    'search_feedback', returning None if there is no cursor or it is malformed."""
+    if not cursor:
+        return None
+    score, _, feedback_id = cursor.rpartition(":")
+    try:
+        return float(score), int(feedback_id)
+    except ValueError:
+        return None
+
+def search_feedback(text, after=None, limit=20):
+    """A function that returns one page of the feedback matching the words in 'text', best matches
+    first, as a list of (id, title, username, score) rows, plus the cursor to pass as 'after' for the
+    next page (None if this is the last page). Pages continue after the (score, id) in 'after', so
+    later pages cost the same as the first."""
+    if not text.split():
+        return [], None
+    params = {"limit": limit + 1}
+    if after:
+        params["after_score"], params["after_id"] = after
+        seek = ("WHERE score < :after_score OR (score = :after_score AND id < :after_id) ")
+    else:
+        seek = ""
+
+    if db.engine.dialect.name == "postgresql":
+        params["text"] = text
+        #ts_rank() returns a real, which would not compare equal to the double precision score read
+        #back from a cursor, so it is cast to one.
+        matches = ("SELECT feedback.id AS id, feedback.title AS title, feedback.username AS username, "
+        "ts_rank(search_vector, query)::float8 AS score "
+        "FROM feedback JOIN users ON users.username = feedback.username, "
+        "plainto_tsquery('english', :text) AS query WHERE search_vector @@ query AND {live}")
+    else:
+        params["text"] = _fts5_query(text)
+        #bm25() is lower for better matches, so it is negated to sort the same way as ts_rank().
+        matches = ("SELECT feedback.id AS id, feedback.title AS title, feedback.username AS username, "
+        "-bm25(feedback_fts) AS score FROM feedback_fts JOIN feedback ON feedback.id = feedback_fts.rowid "
+        "JOIN users ON users.username = feedback.username WHERE feedback_fts MATCH :text AND {live}")
+    #Soft-deleted feedback, and the feedback of soft-deleted users, stays indexed until it is purged.
+    matches = matches.format(live="feedback.deleted_at IS NULL AND users.deleted_at IS NULL")
+
+    rows = db.session.execute(sa.text(f"SELECT id, title, username, score FROM ({matches}) AS matches "
+    f"{seek}ORDER BY score DESC, id DESC LIMIT :limit"), params).fetchall()
+    if len(rows) > limit:
+        rows = rows[:limit]
+        return rows, f"{rows[-1].score!r}:{rows[-1].id}"
+    return rows, None
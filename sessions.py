@@ -0,0 +1,199 @@
+"""Server-side sessions for the Commentator app. Instead of keeping the whole session in a signed
+cookie, the browser gets a short random id and the session itself is kept on the server, where it
+can be revoked (for example, when an account is deleted).
+
+The store is chosen with the SESSION_BACKEND setting:
+'cookie': Flask's usual signed cookie sessions (the default). Nothing is kept on the server.
+'sql': the 'sessions' table of the app's database.
+'memory': a dictionary in each process, standing in for a shared store like Redis in local runs.
+
+Recently used sessions are kept in a small in-process LRU cache so most requests do not have to
+read the store, and expired sessions are removed in batches every SESSION_SWEEP_INTERVAL seconds."""
+
+import secrets
+import threading
+import time
+from datetime import datetime
+
+import sqlalchemy as sa
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+
+from cache import LRUCache
+from models import db, StoredSession
+
+class ServerSession(CallbackDict, SessionMixin):
+    """A session whose contents are kept on the server under the random id 'sid'. 'opened_by' is the
+    user it belonged to when it was opened, so a change of user can be noticed when it is saved."""
+
+    def __init__(self, initial=None, sid=None, new=False):
+        def on_update(self):
+            self.modified = True
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+        self.opened_by = self.get("user_id")
+
+class MemorySessionStore:
+    """Keeps sessions in a dictionary in this process."""
+
+    def __init__(self):
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def load(self, sid):
+        """A method that returns the (data, expires_at) stored for 'sid', or None."""
+        with self._lock:
+            entry = self._sessions.get(sid)
+        return entry and (entry[0], entry[2])
+
+    def save(self, sid, data, username, expires_at):
+        """A method that stores 'data' for 'sid', belonging to 'username', until 'expires_at'."""
+        with self._lock:
+            self._sessions[sid] = (data, username, expires_at)
+
+    def delete(self, sid):
+        """A method that removes the session 'sid'."""
+        with self._lock:
+            self._sessions.pop(sid, None)
+
+    def delete_user_sessions(self, username):
+        """A method that removes every session belonging to 'username' and returns their ids."""
+        with self._lock:
+            sids = [sid for sid, entry in self._sessions.items() if entry[1] == username]
+            for sid in sids:
+                del self._sessions[sid]
+        return sids
+
+    def sweep(self, now, batch_size):
+        """A method that removes up to 'batch_size' sessions that expired before 'now' and returns
+        how many it removed."""
+        with self._lock:
+            expired = [sid for sid, entry in self._sessions.items() if entry[2] <= now][:batch_size]
+            for sid in expired:
+                del self._sessions[sid]
+        return len(expired)
+
+class SQLSessionStore:
+    """Keeps sessions in the 'sessions' table. It uses its own short transactions rather than the
+    request's database session, so saving a session never commits anything a view left pending."""
+
+    table = StoredSession.__table__
+
+    def load(self, sid):
+        with db.engine.connect() as connection:
+            row = connection.execute(sa.select(self.table.c.data, self.table.c.expires_at)
+            .where(self.table.c.id == sid)).first()
+        return row and (row.data, row.expires_at)
+
+    def save(self, sid, data, username, expires_at):
+        with db.engine.begin() as connection:
+            updated = connection.execute(self.table.update().where(self.table.c.id == sid)
+            .values(data=data, username=username, expires_at=expires_at)).rowcount
+            if not updated:
+                connection.execute(self.table.insert().values(id=sid, data=data, username=username,
+                expires_at=expires_at))
+
+    def delete(self, sid):
+        with db.engine.begin() as connection:
+            connection.execute(self.table.delete().where(self.table.c.id == sid))
+
+    def delete_user_sessions(self, username):
+        with db.engine.begin() as connection:
+            sids = [row.id for row in connection.execute(sa.select(self.table.c.id)
+            .where(self.table.c.username == username))]
+            connection.execute(self.table.delete().where(self.table.c.username == username))
+        return sids
+
+    def sweep(self, now, batch_size):
+        expired = sa.select(self.table.c.id).where(self.table.c.expires_at <= now).limit(batch_size)
+        with db.engine.begin() as connection:
+            return connection.execute(self.table.delete().where(self.table.c.id.in_(expired))).rowcount
+
+class ServerSideSessionInterface(SessionInterface):
+    """A Flask session interface that keeps sessions in 'store' and only sends their ids to the
+    browser."""
+
+    serializer = TaggedJSONSerializer()
+
+    def __init__(self, store, hot_cache_size=1024, hot_cache_ttl=30, sweep_interval=300, sweep_batch=1000):
+        self.store = store
+        #Holds (data, expires_at) for recently used sessions. Other processes may keep serving a
+        #revoked session from their own copy for up to 'hot_cache_ttl' seconds.
+        self.hot = LRUCache(max_entries=hot_cache_size, ttl=hot_cache_ttl)
+        self.sweep_interval = sweep_interval
+        self.sweep_batch = sweep_batch
+        self._next_sweep = time.monotonic() + sweep_interval
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(app.session_cookie_name)
+        if sid:
+            entry = self.hot.get(sid)
+            if entry is None:
+                entry = self.store.load(sid)
+            if entry is not None and entry[1] > datetime.utcnow():
+                self.hot.set(sid, entry)
+                return ServerSession(self.serializer.loads(entry[0]), sid=sid)
+        return ServerSession(sid=secrets.token_urlsafe(18), new=True)
+
+    def save_session(self, app, session, response):
+        self.maybe_sweep()
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if not session:
+            if session.modified and not session.new:
+                self.store.delete(session.sid)
+                self.hot.delete(session.sid)
+                response.delete_cookie(app.session_cookie_name, domain=domain, path=path)
+            return
+        if not session.modified:
+            return
+        #A new id whenever someone logs in or out, so an id handed out before (for example, to
+        #someone who then sent the victim a link carrying it) never gains their login.
+        if not session.new and session.get("user_id") != session.opened_by:
+            self.store.delete(session.sid)
+            self.hot.delete(session.sid)
+            session.sid = secrets.token_urlsafe(18)
+        expires_at = datetime.utcnow() + app.permanent_session_lifetime
+        data = self.serializer.dumps(dict(session))
+        self.store.save(session.sid, data, session.get("user_id"), expires_at)
+        self.hot.set(session.sid, (data, expires_at))
+        response.set_cookie(app.session_cookie_name, session.sid,
+        expires=self.get_expiration_time(app, session), httponly=self.get_cookie_httponly(app),
+        domain=domain, path=path, secure=self.get_cookie_secure(app),
+        samesite=self.get_cookie_samesite(app))
+
+    def revoke_user_sessions(self, username):
+        """A method that ends every session belonging to 'username'."""
+        for sid in self.store.delete_user_sessions(username):
+            self.hot.delete(sid)
+
+    def maybe_sweep(self):
+        """A method that removes one batch of expired sessions from the store if it has been at least
+        'sweep_interval' seconds since the last batch."""
+        if time.monotonic() < self._next_sweep:
+            return
+        self._next_sweep = time.monotonic() + self.sweep_interval
+        self.store.sweep(datetime.utcnow(), self.sweep_batch)
+
+def init_app(app):
+    """A function that switches 'app' to server-side sessions if its SESSION_BACKEND asks for them."""
+    backend = app.config.get("SESSION_BACKEND", "cookie")
+    if backend == "cookie":
+        return
+    stores = {"sql": SQLSessionStore, "memory": MemorySessionStore}
+    if backend not in stores:
+        raise ValueError(f"Unknown SESSION_BACKEND {backend!r}.")
+    app.session_interface = ServerSideSessionInterface(stores[backend](),
+    hot_cache_size=app.config.get("SESSION_HOT_CACHE_SIZE", 1024),
+    hot_cache_ttl=app.config.get("SESSION_HOT_CACHE_TTL", 30),
+    sweep_interval=app.config.get("SESSION_SWEEP_INTERVAL", 300),
+    sweep_batch=app.config.get("SESSION_SWEEP_BATCH", 1000))
+
+def revoke_user_sessions(app, username):
+    """A function that ends every server-side session of 'username'. Sessions kept in signed cookies
+    cannot be revoked, so this does nothing when SESSION_BACKEND is 'cookie'."""
+    if isinstance(app.session_interface, ServerSideSessionInterface):
+        app.session_interface.revoke_user_sessions(username)
@@ -0,0 +1,70 @@
+"""Template caching for the Commentator app.
+
+Compiled templates can be kept on disk in TEMPLATE_CACHE_DIR, so a new worker loads their bytecode
+instead of parsing and compiling every template again. 'flask compile-templates' fills the cache
+ahead of time, for example while deploying.
+
+Parts of a page can be cached with the '{% cache %}' tag, which stores what its body renders in the
+app's cache (see 'cache.py') under a key made from the tag's arguments:
+
+    {% cache "user_feedback", user.username, user.version %}...{% endcache %}
+
+Including a version that changes with the content in the key means a change never has to be
+invalidated; the old fragment is simply never asked for again and expires on its own."""
+
+import os
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from jinja2 import FileSystemBytecodeCache, nodes
+from jinja2.ext import Extension
+from markupsafe import Markup
+
+from cache import cache
+
+class FragmentCacheExtension(Extension):
+    """Adds the '{% cache key, parts... %}...{% endcache %}' tag to templates."""
+
+    tags = {"cache"}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        parts = [parser.parse_expression()]
+        while parser.stream.skip_if("comma"):
+            parts.append(parser.parse_expression())
+        body = parser.parse_statements(["name:endcache"], drop_needle=True)
+        return nodes.CallBlock(self.call_method("_render_cached", [nodes.List(parts)]), [], [], body
+        ).set_lineno(lineno)
+
+    def _render_cached(self, parts, caller):
+        key = "fragment:" + ":".join(str(part) for part in parts)
+        fragment = cache.get(key, "fragment")
+        if fragment is None:
+            fragment = str(caller())
+            cache.set(key, fragment)
+        #The fragment was escaped when it was rendered, so it must not be escaped again.
+        return Markup(fragment)
+
+def init_app(app):
+    """A function that sets up the template bytecode cache (if TEMPLATE_CACHE_DIR is set) and the
+    '{% cache %}' tag for 'app'. It must run before any template is rendered."""
+    options = dict(app.jinja_options)
+    options["extensions"] = list(options.get("extensions", [])) + [FragmentCacheExtension]
+    cache_dir = app.config.get("TEMPLATE_CACHE_DIR")
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+        options["bytecode_cache"] = FileSystemBytecodeCache(cache_dir)
+    app.jinja_options = options
+    app.cli.add_command(compile_templates)
+
+@click.command("compile-templates")
+@with_appcontext
+def compile_templates():
+    """Compiles every template into the bytecode cache in TEMPLATE_CACHE_DIR."""
+    if not current_app.config.get("TEMPLATE_CACHE_DIR"):
+        raise click.ClickException("TEMPLATE_CACHE_DIR is not set, so there is no cache to fill.")
+    names = current_app.jinja_env.list_templates()
+    for name in names:
+        current_app.jinja_env.get_template(name)
+    print(f"Compiled {len(names)} templates into {current_app.config['TEMPLATE_CACHE_DIR']}.")
@@ -0,0 +1,147 @@
+"""Login throttling for the Commentator app. Failed logins are counted in a sliding window per
+username and per client IP address, and once either count reaches its limit further attempts are
+turned away before the database is queried or a password is hashed.
+
+Settings read by 'LoginThrottle.init_app':
+LOGIN_THROTTLE_BACKEND: 'memory' (each process counts on its own) or 'redis' (shared).
+LOGIN_THROTTLE_REDIS_URL: the Redis server for the 'redis' backend.
+LOGIN_FAILURE_WINDOW: the length of the sliding window in seconds.
+LOGIN_MAX_FAILURES_PER_USER, LOGIN_MAX_FAILURES_PER_IP: how many failures each window allows."""
+
+import threading
+import time
+import uuid
+from collections import deque
+
+from metrics import metrics
+
+class MemoryWindowStore:
+    """Keeps the times of recent events for each key in this process. At most 'limit' times are kept
+    per key, since older ones can never matter to the limit."""
+
+    def __init__(self):
+        self._events = {}
+        self._lock = threading.Lock()
+
+    def add(self, key, now, window, limit):
+        """A method that records an event for 'key' at time 'now'."""
+        with self._lock:
+            events = self._events.get(key)
+            if events is None or events.maxlen != limit:
+                events = self._events[key] = deque(events or (), maxlen=limit)
+            events.append(now)
+            #Occasionally forgets keys with no recent events so the dictionary cannot grow forever.
+            if len(self._events) > 10000:
+                for stale in [k for k, v in self._events.items() if not v or v[-1] <= now - window]:
+                    del self._events[stale]
+
+    def recent(self, key, now, window):
+        """A method that returns the times of the events for 'key' within 'window' seconds of 'now',
+        oldest first."""
+        with self._lock:
+            return [event for event in self._events.get(key, ()) if event > now - window]
+
+    def clear(self, key):
+        """A method that forgets every event for 'key'."""
+        with self._lock:
+            self._events.pop(key, None)
+
+class RedisWindowStore:
+    """Keeps the times of recent events for each key in a Redis sorted set, shared by every process."""
+
+    def __init__(self, client, prefix="commentator:throttle:"):
+        self.client = client
+        self.prefix = prefix
+
+    @classmethod
+    def from_url(cls, url):
+        """A class method that connects to the Redis server at 'url'."""
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("LOGIN_THROTTLE_BACKEND 'redis' needs the 'redis' package installed.")
+        return cls(redis.Redis.from_url(url))
+
+    def add(self, key, now, window, limit):
+        key = self.prefix + key
+        pipeline = self.client.pipeline()
+        pipeline.zremrangebyscore(key, 0, now - window)
+        pipeline.zadd(key, {f"{now}:{uuid.uuid4().hex[:8]}": now})
+        pipeline.expire(key, int(window) + 1)
+        pipeline.execute()
+
+    def recent(self, key, now, window):
+        return [score for _, score in self.client.zrangebyscore(self.prefix + key, now - window, "+inf",
+        withscores=True)]
+
+    def clear(self, key):
+        self.client.delete(self.prefix + key)
+
+class SlidingWindowLimiter:
+    """Allows at most 'limit' events per key in any 'window' seconds."""
+
+    def __init__(self, store, limit, window):
+        self.store = store
+        self.limit = limit
+        self.window = window
+
+    def retry_after(self, key, now=None):
+        """A method that returns how many seconds until another event is allowed for 'key' (0 if one
+        is allowed now)."""
+        now = time.time() if now is None else now
+        recent = self.store.recent(key, now, self.window)
+        if len(recent) < self.limit:
+            return 0
+        return recent[-self.limit] + self.window - now
+
+    def hit(self, key, now=None):
+        """A method that records an event for 'key'."""
+        self.store.add(key, time.time() if now is None else now, self.window, self.limit)
+
+    def reset(self, key):
+        """A method that forgets every event recorded for 'key'."""
+        self.store.clear(key)
+
+class LoginThrottle:
+    """Counts failed logins per username and per client IP address."""
+
+    def __init__(self):
+        self.enabled = False
+
+    def init_app(self, app):
+        """A method that sets up the store and the limits from the config of 'app'."""
+        backend = app.config.get("LOGIN_THROTTLE_BACKEND", "memory")
+        if backend == "memory":
+            store = MemoryWindowStore()
+        elif backend == "redis":
+            store = RedisWindowStore.from_url(app.config["LOGIN_THROTTLE_REDIS_URL"])
+        else:
+            raise ValueError(f"Unknown LOGIN_THROTTLE_BACKEND {backend!r}.")
+        window = app.config.get("LOGIN_FAILURE_WINDOW", 60)
+        self.per_user = SlidingWindowLimiter(store, app.config.get("LOGIN_MAX_FAILURES_PER_USER", 10), window)
+        self.per_ip = SlidingWindowLimiter(store, app.config.get("LOGIN_MAX_FAILURES_PER_IP", 50), window)
+        self.enabled = True
+
+    def retry_after(self, username, ip):
+        """A method that returns how many seconds the client at 'ip' must wait before trying to log in
+        as 'username' again, or 0 if it may try now."""
+        if not self.enabled:
+            return 0
+        wait = max(self.per_user.retry_after(f"user:{username}"), self.per_ip.retry_after(f"ip:{ip}"))
+        if wait:
+            metrics.increment("login_throttled_total")
+        return wait
+
+    def failed(self, username, ip):
+        """A method that records a failed login as 'username' from 'ip'."""
+        if self.enabled:
+            self.per_user.hit(f"user:{username}")
+            self.per_ip.hit(f"ip:{ip}")
+
+    def succeeded(self, username):
+        """A method that forgets the failed logins for 'username' after a successful login. Failures
+        from the client's IP address are kept."""
+        if self.enabled:
+            self.per_user.reset(f"user:{username}")
+
+login_throttle = LoginThrottle()